@@ -1,3 +1,5 @@
 from .lnk_csma_ahsm import LnkHeymacCsmaAhsm
-from .lnk_frame import HeymacFrame, HeymacFrameError
-from .lnk_heymac_cmd import HeymacCmdTxt, HeymacCmdCsmaBcn
+from .lnk_frame import HeymacFrame, HeymacFrameError, parse_columnar
+from .lnk_heymac_cmd import HeymacCmdTxt, HeymacCmdZtxt, HeymacCmdCsmaBcn, \
+    HeymacCmdCsmaBcnHashed, HeymacCmdAggr, HeymacCmdFrag
+from .lnk_frag import LnkFragReassembler
@@ -5,6 +5,7 @@ Data Link Layer (LNK) state machine for Carrier-Sense Multiple Access (CSMA)
 radio operations using Heymac frame protocol.
 - listens for beacons and maintains a neighbors list with link stats
 - periodically transmits a beacon frame
+- aggregates small commands and fragments large datagrams
 """
 
 
@@ -14,6 +15,7 @@ import farc
 import phy_sx127x
 
 from . import lnk_data
+from . import lnk_frag
 from . import lnk_frame
 from . import lnk_heymac_cmd
 from heymac.utl import ham_ident
@@ -29,6 +31,7 @@ class LnkHeymac(object):
     # These are bit flags used in the beacon's capabilities field.
     LNK_CAP_PWR = 0x0001        # Node has surplus power
     LNK_CAP_RXCONT = 0x0002     # Node is able to listen continuously
+    LNK_CAP_ZTXT = 0x0004       # Node can receive HeymacCmdZtxt
     LNK_CAP_CRYPTO = 0          # Node is capable of cryptographic routines
     # LNK_CAP_ROOT # No, this is net layer cap
     # LNK_CAP_NVSTO # Node has non-volatile storage (KBs? MBs? GBs?)
@@ -37,6 +40,33 @@ class LnkHeymac(object):
     # This value also affects the time a node spends lurking.
     _BCN_PRD = 32
 
+    # A beacon lists its neighbors by their link address while they fit
+    # in a frame; more neighbors are sent in the hashed (compact) form,
+    # as many as fit, those with the best link quality first.
+    # The beacon frame's PID, Fctl and SrcAddr come before the command;
+    # the command's prefix, caps, status and array counts come before
+    # the nets (each a NetId and root address) and neighbors.
+    _BCN_FRM_HDR_SZ = 2 + LNK_ADDR_SZ
+    _BCN_CMD_HDR_SZ = 1 + 2 + 2 + 1 + 1
+    _BCN_NET_SZ = 2 + LNK_ADDR_SZ
+    _BCN_NGBR_HASH_SZ = 2
+
+    # Queued commands to the same destination are aggregated
+    # into payloads of up to this many octets
+    _AGGR_PAYLD_MAX = 200
+
+    # A datagram larger than a frame is sent in fragments that carry
+    # up to _FRAG_SZ octets of it.  Up to _FRAG_POOL_SZ datagrams of up
+    # to _DGRAM_SZ_MAX octets are reassembled at once and those that
+    # do not complete in _FRAG_TIMEOUT seconds are dropped.
+    _FRAG_SZ = 192
+    _FRAG_POOL_SZ = 4
+    _DGRAM_SZ_MAX = 4096
+    _FRAG_TIMEOUT = 8
+
+    # A neighbor not heard from for this many seconds is dropped
+    _NGBR_EXPIRATION_PRD = 4 * _BCN_PRD
+
     # The number of seconds between each link update period in _linking()
     _LNK_UPDT_PRD = 4
 
@@ -79,9 +109,95 @@ class LnkHeymacCsmaAhsm(LnkHeymac, farc.Ahsm):
         self.phy_ahsm.set_dflt_rx_clbk(self._phy_rx_clbk)
 
         self._rx_clbk = None
+        self._dgram_clbk = None
+
+        # Serialized commands waiting to be sent, by destination
+        self._cmd_txq = {}
+
+        # Fragmentation: the next datagram's ID and the reassembly pool
+        self._dgram_id = 0
+        self._frag_reasm = lnk_frag.LnkFragReassembler(
+            LnkHeymac._FRAG_POOL_SZ,
+            LnkHeymac._DGRAM_SZ_MAX,
+            LnkHeymac._FRAG_TIMEOUT)
 
         self._lnk_addr = ham_ident.HamIdent.get_long_addr("HeyMac")
-        self._lnk_data = lnk_data.LnkData(self._lnk_addr)
+        self._lnk_data = lnk_data.LnkData(
+            self._lnk_addr,
+            LnkHeymac._NGBR_EXPIRATION_PRD,
+            LnkHeymac._BCN_PRD)
+
+        # The serialized beacon frame and the link data generation
+        # it was made from (rebuilt only when the generation changes)
+        self._bcn_bytes = None
+        self._bcn_gen = None
+
+
+    def post_cmd(self, cmd, daddr=None):
+        """Queues the Heymac command for transmit to the given
+        destination link address (or to all neighbors if daddr is None).
+
+        Commands queued for the same destination, before the queue
+        is flushed, are sent together in aggregate frames.
+
+        Raises HeymacCmdError if the command does not fit in a frame.
+        """
+        cmd_bytes = bytes(cmd)
+        if len(cmd_bytes) > self._get_cmd_sz_max(daddr):
+            raise lnk_heymac_cmd.HeymacCmdError(
+                "Command is too large for a frame")
+        if not self._cmd_txq:
+            self.post_fifo(farc.Event(farc.Signal._LNK_TXQ_FLUSH, None))
+        self._cmd_txq.setdefault(daddr, []).append(cmd_bytes)
+
+
+    def post_dgram(self, dgram, daddr=None):
+        """Posts the datagram to the PHY for transmit to the given
+        destination link address (or to all neighbors if daddr is None).
+
+        The datagram is sent in Fragments (HeymacCmdFrag), so it may be
+        larger than a frame (up to _DGRAM_SZ_MAX octets).  The receiver
+        gives the reassembled datagram to its dgram_clbk.
+        """
+        if len(dgram) > LnkHeymac._DGRAM_SZ_MAX:
+            raise lnk_heymac_cmd.HeymacCmdError("Datagram is too large")
+        frags = lnk_heymac_cmd.HeymacCmdFrag.from_dgram(
+            dgram, self._dgram_id, LnkHeymac._FRAG_SZ)
+        self._dgram_id = (self._dgram_id + 1) & 0xFFFF
+        for frag in frags:
+            self._post_frm(self._mk_cmd_frame(daddr, bytes(frag)))
+
+
+    def post_txt(self, msg, daddr=None):
+        """Queues the text message for transmit to the given
+        destination link address (or to all neighbors if daddr is None).
+
+        The text is compressed if that makes it smaller and if the
+        destination (or every neighbor) has the LNK_CAP_ZTXT capability.
+        """
+        if daddr is None:
+            caps = [self._lnk_data.get_ngbr_caps(ngbr_addr)
+                    for ngbr_addr in self._lnk_data.get_ngbrs_lnk_addrs()]
+        else:
+            caps = [self._lnk_data.get_ngbr_caps(daddr)]
+        if caps and all(cap is not None and cap & LnkHeymac.LNK_CAP_ZTXT
+                        for cap in caps):
+            cmd = lnk_heymac_cmd.HeymacCmdZtxt.from_msg(msg)
+        else:
+            cmd = lnk_heymac_cmd.HeymacCmdTxt(FLD_MSG=msg)
+        self.post_cmd(cmd, daddr)
+
+
+    def set_dgram_clbk(self, dgram_clbk):
+        """Sets the callback for each datagram received (see post_dgram()).
+
+        It is called as dgram_clbk(frame, dgram): the frame is that of
+        the datagram's last fragment (for its addresses and reception
+        meta-data) and dgram is the reassembled datagram (bytes).
+        Datagrams are not given to the rx_clbk, so a datagram is never
+        mistaken for a frame's command.
+        """
+        self._dgram_clbk = dgram_clbk
 
 
     def set_rx_clbk(self, rx_clbk):
@@ -100,6 +216,7 @@ class LnkHeymacCsmaAhsm(LnkHeymac, farc.Ahsm):
         # Self-signaling
         farc.Signal.register("_ALWAYS")
         farc.Signal.register("_LNK_RXD_FROM_PHY")
+        farc.Signal.register("_LNK_TXQ_FLUSH")
 
         # Self-signaling events
         self._evt_always = farc.Event(farc.Signal._ALWAYS, None)
@@ -150,6 +267,9 @@ class LnkHeymacCsmaAhsm(LnkHeymac, farc.Ahsm):
         if sig == farc.Signal.ENTRY:
             logging.debug("LNK._lurking")
             self._bcn_evt.post_in(self, 2 * LnkHeymac._BCN_PRD)
+            # The flush of commands queued while initializing was dropped
+            if self._cmd_txq:
+                self.post_fifo(farc.Event(farc.Signal._LNK_TXQ_FLUSH, None))
             return self.handled(event)
 
         elif sig == farc.Signal._LNK_BCN_TMOUT:
@@ -159,6 +279,10 @@ class LnkHeymacCsmaAhsm(LnkHeymac, farc.Ahsm):
             self._on_rxd_from_phy(event.value)
             return self.handled(event)
 
+        elif sig == farc.Signal._LNK_TXQ_FLUSH:
+            self._flush_cmd_txq()
+            return self.handled(event)
+
         elif sig == farc.Signal.EXIT:
             self._bcn_evt.disarm()
             return self.handled(event)
@@ -231,31 +355,131 @@ class LnkHeymacCsmaAhsm(LnkHeymac, farc.Ahsm):
         """Processes a frame received from the PHY."""
         assert type(frame) is lnk_frame.HeymacFrame
 
-        # Attach the Heymac command, if present
-        try:
-            cmd = lnk_heymac_cmd.HeymacCmd.parse(
-                frame.get_field(lnk_frame.HeymacFrame.FLD_PAYLD))
-        except lnk_heymac_cmd.HeymacCmdError:
-            cmd = None
-        frame.cmd = cmd
+        # The Heymac command (frame.cmd) is decoded only if
+        # the link data or the NET layer asks for it
+
+        # An aggregate is processed as a frame per command
+        # (each command is still decoded only if it is asked for)
+        if frame.get_cmd_id() == lnk_heymac_cmd.HeymacCmdAggr.CMD_ID \
+                and frame.cmd is not None:
+            cmd_frames = [frame.copy_with_payld(cmd_bytes)
+                          for cmd_bytes in frame.cmd.get_cmds_bytes()]
+        else:
+            cmd_frames = (frame,)
 
         # Process the frame for link data, etc.
-        self._lnk_data.process_frame(frame)
+        # (once per reception, not once per aggregated command)
+        self._lnk_data.process_frame(frame, cmd_frames)
 
         # If the frame is a multi-hop Heymac command
-        if frame.cmd and frame.is_mhop():
+        # (one that decodes; a multi-hop frame is decoded to be relayed)
+        if frame.is_mhop() and frame.cmd is not None:
             hops = frame.get_field(lnk_frame.HeymacFrame.FLD_HOPS)
             if hops > 1:
-                # Update the hops and re-transmitter fields
-                frame.set_field(lnk_frame.HeymacFrame.FLD_HOPS, hops - 1)
-                frame.set_field(lnk_frame.HeymacFrame.FLD_TADDR,
-                                self._lnk_addr)
-                # Post the frame to PHY for transmission
-                self._post_frm(frame)
+                # Post the frame, with updated hops and re-transmitter
+                # fields, to PHY for transmission
+                self._post_relay(frame)
+
+        # Allow the NET layer to process the frame.
+        # Fragments are reassembled and a complete datagram
+        # is given to the datagram callback.
+        for cmd_frame in cmd_frames:
+            if cmd_frame.get_cmd_id() == lnk_heymac_cmd.HeymacCmdFrag.CMD_ID:
+                if self._dgram_clbk:
+                    dgram = self._reassemble(cmd_frame)
+                    if dgram is not None:
+                        self._dgram_clbk(cmd_frame, dgram)
+            elif self._rx_clbk:
+                self._rx_clbk(cmd_frame)
+
+
+    def _reassemble(self, frame):
+        """Adds the Fragment in the frame to its datagram.
+
+        Returns the datagram (bytes) if it is complete.
+        Otherwise returns None.
+        """
+        # Fragments are keyed by their source, not by the node that
+        # relayed them, which may differ from one fragment to the next
+        saddr = frame.get_field(lnk_frame.HeymacFrame.FLD_SADDR)
+        frag = frame.cmd
+        if saddr is None or type(frag) is not lnk_heymac_cmd.HeymacCmdFrag:
+            return None
+        dgram = self._frag_reasm.add_frag(
+            saddr,
+            frag.get_field(lnk_heymac_cmd.HeymacCmd.FLD_DGRAM_ID),
+            frag.get_field(lnk_heymac_cmd.HeymacCmd.FLD_DGRAM_SZ),
+            frag.get_field(lnk_heymac_cmd.HeymacCmd.FLD_FRAG_OFF),
+            frag.get_field(lnk_heymac_cmd.HeymacCmd.FLD_FRAG),
+            frame.rx_meta[0])
+        if dgram is None:
+            return None
+        # The datagram is copied out of the reassembly pool's buffer,
+        # which the next fragment may reuse before the NET layer reads it
+        return bytes(dgram)
+
+
+    def _flush_cmd_txq(self,):
+        """Posts the queued commands to the PHY for transmit.
+
+        The commands for each destination are packed into as few
+        aggregate frames as fit, in the order they were queued.
+        A lone (or large) command is sent in a frame of its own.
+        Every queued command fits in a frame (see post_cmd()),
+        so it also fits in an aggregate (HeymacCmdAggr.CMD_SZ_MAX).
+        """
+        # The queue is emptied first so that an error while sending
+        # cannot leave commands in it (and stop later flushes)
+        cmd_txq = self._cmd_txq
+        self._cmd_txq = {}
+        for daddr, cmds in cmd_txq.items():
+            batch = []
+            batch_sz = 1
+            for cmd_bytes in cmds + [None]:
+                if batch and (cmd_bytes is None or batch_sz + 1 +
+                              len(cmd_bytes) > LnkHeymac._AGGR_PAYLD_MAX):
+                    if len(batch) == 1:
+                        payld = batch[0]
+                    else:
+                        payld = bytes(
+                            lnk_heymac_cmd.HeymacCmdAggr.from_cmds(batch))
+                    self._post_frm(self._mk_cmd_frame(daddr, payld))
+                    batch = []
+                    batch_sz = 1
+                if cmd_bytes is None:
+                    break
+                batch.append(cmd_bytes)
+                batch_sz += 1 + len(cmd_bytes)
+
+
+    @staticmethod
+    def _get_cmd_sz_max(daddr):
+        """Returns the largest command that fits in a frame
+        from this node to daddr (or to all neighbors if daddr is None).
+        """
+        # PID, Fctl, SrcAddr and DstAddr (if any)
+        hdr_sz = 2 + LnkHeymac.LNK_ADDR_SZ
+        if daddr is not None:
+            hdr_sz += len(daddr)
+        return lnk_frame.HeymacFrame.FRAME_SZ_MAX - hdr_sz
 
-        # Allow the NET layer to process the frame
-        if self._rx_clbk:
-            self._rx_clbk(frame)
+
+    def _mk_cmd_frame(self, daddr, payld):
+        """Returns a frame from this node to daddr (or to all neighbors
+        if daddr is None) with the given payload.
+        """
+        fctl = lnk_frame.HeymacFrame.FCTL_L | lnk_frame.HeymacFrame.FCTL_S
+        if daddr is not None:
+            fctl |= lnk_frame.HeymacFrame.FCTL_D
+        frame = lnk_frame.HeymacFrame(
+            lnk_frame.HeymacFrame.PID_IDENT_HEYMAC |
+            lnk_frame.HeymacFrame.PID_TYPE_CSMA,
+            fctl)
+        if daddr is not None:
+            frame.set_field(lnk_frame.HeymacFrame.FLD_DADDR, daddr)
+        frame.set_field(lnk_frame.HeymacFrame.FLD_SADDR, self._lnk_addr)
+        frame.set_field(lnk_frame.HeymacFrame.FLD_PAYLD, payld)
+        return frame
 
 
     def _phy_rx_clbk(self, rx_time, rx_bytes, rx_rssi, rx_snr):
@@ -266,10 +490,10 @@ class LnkHeymacCsmaAhsm(LnkHeymac, farc.Ahsm):
         This method collects the arguments in a container
         and posts an event to this state machine.
         """
-        # Parse the bytes into a frame
+        # Lazily parse the bytes into a frame
         # and store reception meta-data
         try:
-            frame = lnk_frame.HeymacFrame.parse(rx_bytes)
+            frame = lnk_frame.HeymacFrame.parse(rx_bytes, lazy=True)
             frame.rx_meta = (rx_time, rx_rssi, rx_snr)
         except lnk_frame.HeymacFrameError:
             logging.info("LNK:rxd frame is not valid Heymac\n\t{}"
@@ -282,13 +506,47 @@ class LnkHeymacCsmaAhsm(LnkHeymac, farc.Ahsm):
 
 
     def _post_bcn(self,):
-        """Builds a Heymac CsmaBeacon and posts it to the PHY for transmit."""
-        bcn = lnk_heymac_cmd.HeymacCmdCsmaBcn(
-            # TODO: Fill with real data
-            FLD_CAPS=LnkHeymac.LNK_CAP_RXCONT,
-            FLD_STATUS=0,
-            FLD_NETS=(),
-            FLD_NGBRS=self._lnk_data.get_ngbrs_lnk_addrs())
+        """Posts a Heymac CsmaBeacon to the PHY for transmit.
+
+        The beacon is rebuilt only if the link data has changed
+        since the previous beacon.
+        """
+        gen = self._lnk_data.get_generation()
+        if self._bcn_bytes is None or gen != self._bcn_gen:
+            self._bcn_bytes = self._mk_bcn()
+            self._bcn_gen = gen
+        self.phy_ahsm.post_tx_action(
+            self.phy_ahsm.TM_NOW,
+            LnkHeymac._PHY_STNGS_TX,
+            self._bcn_bytes)
+
+
+    def _mk_bcn(self,):
+        """Builds a Heymac CsmaBeacon frame and returns it serialized."""
+        # TODO: Fill with real data
+        caps = LnkHeymac.LNK_CAP_RXCONT | LnkHeymac.LNK_CAP_ZTXT
+        status = 0
+        nets = ()
+        ngbrs = tuple(self._lnk_data.get_ngbrs_lnk_addrs())
+        if len(ngbrs) <= self._get_bcn_ngbrs_max(
+                len(nets), LnkHeymac.LNK_ADDR_SZ):
+            bcn = lnk_heymac_cmd.HeymacCmdCsmaBcn(
+                FLD_CAPS=caps,
+                FLD_STATUS=status,
+                FLD_NETS=nets,
+                FLD_NGBRS=ngbrs)
+        else:
+            ngbrs_max = self._get_bcn_ngbrs_max(
+                len(nets), LnkHeymac._BCN_NGBR_HASH_SZ)
+            if len(ngbrs) > ngbrs_max:
+                ngbrs = sorted(
+                    ngbrs,
+                    key=lambda lnk_addr: (
+                        self._lnk_data.get_link_quality(lnk_addr) or 0.0,
+                        lnk_addr),
+                    reverse=True)[:ngbrs_max]
+            bcn = lnk_heymac_cmd.HeymacCmdCsmaBcnHashed.from_ngbrs(
+                caps, status, nets, ngbrs)
         frame = lnk_frame.HeymacFrame(
             lnk_frame.HeymacFrame.PID_IDENT_HEYMAC
             | lnk_frame.HeymacFrame.PID_TYPE_CSMA,
@@ -296,16 +554,37 @@ class LnkHeymacCsmaAhsm(LnkHeymac, farc.Ahsm):
             | lnk_frame.HeymacFrame.FCTL_S)
         frame.set_field(lnk_frame.HeymacFrame.FLD_SADDR, self._lnk_addr)
         frame.set_field(lnk_frame.HeymacFrame.FLD_PAYLD, bytes(bcn))
+        return bytes(frame)
+
+
+    @staticmethod
+    def _get_bcn_ngbrs_max(nets_cnt, ngbr_sz):
+        """Returns the most neighbors, of ngbr_sz octets each,
+        that a beacon with the given number of nets can list
+        and still fit in a frame (and in its one-octet count).
+        """
+        avail_sz = lnk_frame.HeymacFrame.FRAME_SZ_MAX \
+            - LnkHeymac._BCN_FRM_HDR_SZ \
+            - LnkHeymac._BCN_CMD_HDR_SZ \
+            - LnkHeymac._BCN_NET_SZ * nets_cnt
+        return min(avail_sz // ngbr_sz, 255)
+
+
+    def _post_frm(self, frame):
+        """Posts the frame to the PHY for transmit."""
+        assert type(frame) is lnk_frame.HeymacFrame
         self.phy_ahsm.post_tx_action(
             self.phy_ahsm.TM_NOW,
             LnkHeymac._PHY_STNGS_TX,
             bytes(frame))
 
 
-    def _post_frm(self, frame):
-        """Posts the frame to the PHY for transmit."""
+    def _post_relay(self, frame):
+        """Posts the multihop frame to the PHY to be relayed
+        with this node as the re-transmitter.
+        """
         assert type(frame) is lnk_frame.HeymacFrame
         self.phy_ahsm.post_tx_action(
             self.phy_ahsm.TM_NOW,
             LnkHeymac._PHY_STNGS_TX,
-            bytes(frame))
+            frame.mk_relay(self._lnk_addr))
@@ -2,32 +2,201 @@
 """
 
 
+import heapq
+
 import farc
 
-from . import lnk_csma_ahsm
 from . import lnk_frame
 from . import lnk_heymac_cmd
 
 
-class LnkData(object):
-    """Heymac link layer data.
-
-    _ngbr_data is a dict that holds data for each neighbor.
-    The neighbor's link address is the key.  The value is a dict with items:
+class NgbrRec(object):
+    """The link data kept for one neighbor.
 
     ==================  =======================================================
-    Key                 Value
+    Attribute           Value
     ==================  =======================================================
-    "BCN_CNT"           the number of beacons received since link established
-    "BCN_FRAME"         instance of HeymacCmdCsmaBcn
-    "LATEST_RX_TM"      time of latest RX of any valid HeymacFrame from ngbr
-    "LATEST_RX_RSSI"    RSSI of latest RX of any valid HeymacFrame from ngbr
-    "LATEST_RX_SNR"     SNR of latest RX of any valid HeymacFrame from ngbr
+    bcn_cnt             the number of beacons received since link established
+    bcn_rx_tm           time of latest RX of a beacon from ngbr (or None)
+    latest_rx_tm        time of latest RX of any valid HeymacFrame from ngbr
+    latest_rx_rssi      RSSI of latest RX of any valid HeymacFrame from ngbr
+    latest_rx_snr       SNR of latest RX of any valid HeymacFrame from ngbr
+    rssi_ewma           moving average (EWMA) of RSSI of RX from ngbr
+    snr_ewma            moving average (EWMA) of SNR of RX from ngbr
+    bcn_prr             moving average of the beacon reception ratio
+    caps                the capabilities (FLD_CAPS) in the latest beacon
+    nets                the nets (FLD_NETS) in the latest beacon
+    ngbrs               the neighbors in the latest beacon: a frozenset
+                        of link addresses (or of their hashes)
+    ngbrs_hashed        True if ngbrs holds hashes (from a hashed beacon)
     ==================  =======================================================
+
+    Attributes from the beacon are None until a beacon is received.
+    """
+    __slots__ = (
+        "bcn_cnt", "bcn_rx_tm",
+        "latest_rx_tm", "latest_rx_rssi", "latest_rx_snr",
+        "rssi_ewma", "snr_ewma", "bcn_prr",
+        "caps", "nets", "ngbrs", "ngbrs_hashed")
+
+    def __init__(self,):
+        self.bcn_cnt = 0
+        self.bcn_rx_tm = None
+        self.latest_rx_tm = None
+        self.latest_rx_rssi = None
+        self.latest_rx_snr = None
+        self.rssi_ewma = None
+        self.snr_ewma = None
+        self.bcn_prr = None
+        self.caps = None
+        self.nets = None
+        self.ngbrs = None
+        self.ngbrs_hashed = None
+
+
+class LnkData(object):
+    """Heymac link layer data.
+
+    _ngbr_data is a dict that holds an NgbrRec for each neighbor.
+    The neighbor's link address is the key.
+
+    The generation (see get_generation()) counts the changes to the set
+    of neighbors, to their capabilities and to the nets they advertise.
+
+    A neighbor that is not heard from for expiration_prd seconds
+    is removed by update().  Each neighbor has one entry in
+    the _expiry heap, (deadline, lnk_addr), so update() only touches
+    the neighbors whose deadline has passed.  An entry's deadline is
+    from when it was pushed; a neighbor heard from since then is
+    pushed again with its new deadline rather than removed.
+
+    Each neighbor's link quality (see get_link_quality()) is estimated
+    in constant time and memory per frame from the moving averages of
+    its RSSI and SNR and of its beacon reception ratio.  The beacons
+    expected from a neighbor are counted from the time between the
+    beacons heard and the beacon period, bcn_prd.  The beacons missed
+    since the latest one are counted when the quality is read, so
+    a neighbor that stops beaconing loses quality until it expires.
+
+    _net_index maps each net_id advertised by a neighbor to a dict
+    that maps the net's root to the set of neighbors advertising it.
+    The index is updated as beacons arrive and neighbors expire.
+
+    _two_hop maps each node listed in a neighbor's (full) beacon
+    to the set of neighbors that list it; so it holds the 2-hop
+    neighbors and which 1-hop neighbors cover them.  It is updated
+    as beacons arrive and neighbors expire.  The set of multipoint
+    relays (see get_mprs()) is computed from it when first asked for
+    after a change to the topology.
     """
-    def __init__(self, lnk_addr):
+    def __init__(self, lnk_addr, expiration_prd=None, bcn_prd=None):
         self._lnk_addr = lnk_addr
+        if bcn_prd is None:
+            bcn_prd = LnkData._BCN_PRD_DFLT
+        self._bcn_prd = bcn_prd
         self._ngbr_data = {}
+        self._gen = 0
+        if expiration_prd is None:
+            expiration_prd = LnkData._EXPIRATION_PRD_DFLT
+        self._expiration_prd = expiration_prd
+        self._expiry = []
+        # Neighbors whose latest beacon lists this node
+        self._bidir_ngbrs = set()
+        # {net_id: {root: set of neighbors advertising the net}}
+        self._net_index = {}
+        # {lnk_addr: set of neighbors whose beacon lists lnk_addr}
+        self._two_hop = {}
+        # The multipoint relays (None until computed for the topology)
+        self._mprs = None
+        # The latest time seen (in a frame's rx meta data or update())
+        self._latest_tm = None
+
+
+    def get_generation(self,):
+        """Returns a number that changes whenever the set of neighbors,
+        their capabilities or the nets they advertise changes.
+
+        Data derived from the neighbors (such as this node's beacon)
+        may be kept until the generation changes.
+        """
+        return self._gen
+
+
+    def get_bidir_ngbrs_cnt(self,):
+        """Returns the number of neighbors that hear this node
+        (whose latest beacon lists this node).
+        """
+        return len(self._bidir_ngbrs)
+
+
+    def get_covering_ngbrs(self, lnk_addr):
+        """Returns the set of neighbors whose latest beacon
+        lists the node, lnk_addr (so that they can relay to it).
+        """
+        return set(self._two_hop.get(lnk_addr, ()))
+
+
+    def get_mprs(self,):
+        """Returns the frozenset of multipoint relays (MPRs):
+        a small set of bidirectional neighbors that, between them,
+        reach every 2-hop neighbor they can.
+
+        A frame relayed only by the MPRs reaches the same 2-hop
+        neighbors as one relayed by every neighbor.
+        The set is kept until the topology changes.
+        """
+        if self._mprs is None:
+            self._mprs = self._mk_mprs()
+        return self._mprs
+
+
+    def get_two_hop_ngbrs(self,):
+        """Returns the set of 2-hop neighbors: nodes that are listed in
+        a neighbor's beacon but are not this node or a neighbor.
+        """
+        return {lnk_addr for lnk_addr in self._two_hop
+                if lnk_addr != self._lnk_addr and
+                lnk_addr not in self._ngbr_data}
+
+
+    def get_link_quality(self, lnk_addr, now=None):
+        """Returns the quality of the link from the neighbor,
+        0.0 (unusable) to 1.0 (good), or None if it is not known
+        (no beacon has been heard from the neighbor).
+
+        The quality is the beacon reception ratio scaled down
+        when the average SNR nears the demodulator's limit.
+        The beacons missed since the neighbor's latest one, up to
+        the time now (default: the latest time seen in a received
+        frame or update()), are counted against the ratio.
+        """
+        ngbr = self._ngbr_data.get(lnk_addr)
+        if ngbr is None or ngbr.bcn_prr is None:
+            return None
+        if now is None:
+            now = self._latest_tm
+        prr = ngbr.bcn_prr
+        missed = int((now - ngbr.bcn_rx_tm) // self._bcn_prd)
+        if missed > 0:
+            prr *= (1 - LnkData._LQ_ALPHA) ** missed
+        snr_factor = (ngbr.snr_ewma - LnkData._LQ_SNR_MIN) \
+            / (LnkData._LQ_SNR_GOOD - LnkData._LQ_SNR_MIN)
+        return prr * min(max(snr_factor, 0.0), 1.0)
+
+
+    def get_ngbr(self, lnk_addr):
+        """Returns the NgbrRec of the neighbor or None if it is unknown."""
+        return self._ngbr_data.get(lnk_addr)
+
+
+    def get_ngbr_caps(self, lnk_addr):
+        """Returns the capabilities (FLD_CAPS) in the neighbor's latest
+        beacon or None if no beacon has been heard from it.
+        """
+        ngbr = self._ngbr_data.get(lnk_addr)
+        if ngbr is None:
+            return None
+        return ngbr.caps
 
 
     def get_ngbrs_lnk_addrs(self,):
@@ -35,18 +204,41 @@ class LnkData(object):
         return self._ngbr_data.keys()
 
 
+    def get_best_ngbr_to_net(self, net_id):
+        """Returns the link address of the neighbor with the best
+        link quality among those advertising the net,
+        or None if none do.
+        """
+        best_addr = None
+        best_lq = None
+        for ngbrs in self._net_index.get(net_id, {}).values():
+            for ngbr_addr in ngbrs:
+                lq = self.get_link_quality(ngbr_addr)
+                if best_lq is None or lq > best_lq:
+                    best_addr = ngbr_addr
+                    best_lq = lq
+        return best_addr
+
+
+    def get_net_ngbrs(self, net_id):
+        """Returns the set of link addresses of the neighbors
+        advertising the net.
+        """
+        ngbrs = set()
+        for root_ngbrs in self._net_index.get(net_id, {}).values():
+            ngbrs.update(root_ngbrs)
+        return ngbrs
+
+
     def get_ngbrs_nets(self,):
         """Returns a list of neighbors' net data.
 
-        Net data is a tuple of the net_id as a bytes object
-        and the link address of the network's root (also a bytes object).
+        Net data is a tuple of the net_id (an int)
+        and the link address of the network's root (a bytes object).
         """
-        nets = set()
-        for data in self._ngbr_data.values():
-            frame = data["BCN_FRAME"]
-            for net in frame.get_field(HeymacCmd.FLD_NETS):
-                nets.add(net)
-        return list(nets)
+        return [(net_id, root)
+                for net_id, roots in self._net_index.items()
+                for root in roots]
 
 
     def ngbr_hears_me(self,):
@@ -56,46 +248,80 @@ class LnkData(object):
         in its neighbor data.  This proves two-way transmission
         has taken place.
         """
-        for data in self._ngbr_data.values():
-            frame = data["BCN_FRAME"]
-            bcn = frame.cmd
-            assert type(bcn) is lnk_heymac_cmd.HeymacCmdCsmaBcn
-            ngbrs = bcn.get_field(lnk_heymac_cmd.HeymacCmd.FLD_NGBRS)
-            return self._lnk_addr in ngbrs
-        return False
+        return bool(self._bidir_ngbrs)
 
 
-    def process_frame(self, frame):
-        """Update link data with info from the given frame."""
+    def process_frame(self, frame, cmd_frames=None):
+        """Update link data with info from the given frame.
+
+        For an aggregate frame, cmd_frames are the frames of its commands
+        (see HeymacFrame.copy_with_payld()).  The frame's rx meta data
+        is counted once and each command is processed.
+        """
         assert type(frame) is lnk_frame.HeymacFrame
 
         # Init space for a new neighbor
         lnk_addr = frame.get_sender()
-        if lnk_addr not in self._ngbr_data:
-            self._ngbr_data[lnk_addr] = {}
+        ngbr = self._ngbr_data.get(lnk_addr)
+        if ngbr is None:
+            ngbr = NgbrRec()
+            self._ngbr_data[lnk_addr] = ngbr
+            self._gen += 1
+            self._mprs = None
+            heapq.heappush(
+                self._expiry,
+                (frame.rx_meta[0] + self._expiration_prd, lnk_addr))
 
         # Update rx meta data
-        self._ngbr_data[lnk_addr]["LATEST_RX_TM"] = frame.rx_meta[0]
-        self._ngbr_data[lnk_addr]["LATEST_RX_RSSI"] = frame.rx_meta[1]
-        self._ngbr_data[lnk_addr]["LATEST_RX_SNR"] = frame.rx_meta[2]
+        (ngbr.latest_rx_tm, ngbr.latest_rx_rssi, ngbr.latest_rx_snr) \
+            = frame.rx_meta
+        if self._latest_tm is None or ngbr.latest_rx_tm > self._latest_tm:
+            self._latest_tm = ngbr.latest_rx_tm
+        if ngbr.rssi_ewma is None:
+            ngbr.rssi_ewma = ngbr.latest_rx_rssi
+            ngbr.snr_ewma = ngbr.latest_rx_snr
+        else:
+            ngbr.rssi_ewma += LnkData._LQ_ALPHA \
+                * (ngbr.latest_rx_rssi - ngbr.rssi_ewma)
+            ngbr.snr_ewma += LnkData._LQ_ALPHA \
+                * (ngbr.latest_rx_snr - ngbr.snr_ewma)
 
         # Process a beacon
-        if frame.cmd and type(frame.cmd) is lnk_heymac_cmd.HeymacCmdCsmaBcn:
-            self._process_bcn(frame)
+        for cmd_frame in cmd_frames or (frame,):
+            if cmd_frame.get_cmd_id() in LnkData._BCN_CMD_IDS \
+                    and type(cmd_frame.cmd) in LnkData._BCN_CMDS:
+                self._process_bcn(ngbr, cmd_frame)
 
 
-    def update(self,):
-        """Performs periodic update of the link data."""
-        now = farc.Framework._event_loop.time()
-        # Collect and prune expired neighbors
-        expired_ngbrs = []
-        for ngbr_addr, data in self._ngbr_data.items():
-            frame = data["BCN_FRAME"]
-            rx_time = frame.rx_meta[0]
-            if now > rx_time + self._EXPIRATION_PRD:
-                expired_ngbrs.append(ngbr_addr)
-        for ngbr_addr in expired_ngbrs:
-            del self._ngbr_data[ngbr_addr]
+    def update(self, now=None):
+        """Performs periodic update of the link data.
+
+        Removes the neighbors not heard from in the expiration period
+        up to the time now (default: the event loop's time).
+        """
+        if now is None:
+            now = farc.Framework._event_loop.time()
+        if self._latest_tm is None or now > self._latest_tm:
+            self._latest_tm = now
+        expiry = self._expiry
+        expired = False
+        while expiry and now > expiry[0][0]:
+            _, ngbr_addr = expiry[0]
+            deadline = self._ngbr_data[ngbr_addr].latest_rx_tm \
+                + self._expiration_prd
+            if now > deadline:
+                heapq.heappop(expiry)
+                ngbr = self._ngbr_data.pop(ngbr_addr)
+                self._bidir_ngbrs.discard(ngbr_addr)
+                self._index_nets(ngbr_addr, ngbr.nets, None)
+                self._index_two_hop(
+                    ngbr_addr, LnkData._get_listed_ngbrs(ngbr), ())
+                expired = True
+            else:
+                heapq.heapreplace(expiry, (deadline, ngbr_addr))
+        if expired:
+            self._gen += 1
+            self._mprs = None
 
 
 # Private
@@ -103,16 +329,144 @@ class LnkData(object):
 
     # If we don't hear a neighbor (or periodic item)
     # for this many seconds then consider it expired/invalid
-    # FIXME: circular dependency:
-    _EXPIRATION_PRD = 4 * 32 # lnk_csma_ahsm.LnkHeymac._BCN_PRD
+    # (the LNK state machine gives its own period)
+    _EXPIRATION_PRD_DFLT = 4 * 32
 
 
-    def _process_bcn(self, frame):
+    # The period (seconds) of neighbors' beacons
+    # (the LNK state machine gives its own period)
+    _BCN_PRD_DFLT = 32
+
+    # Link quality: the weight of a new sample in the moving averages
+    # and the SNRs (dB) at which a link is unusable and good
+    # (SF7 LoRa demodulates down to about -7.5 dB SNR)
+    _LQ_ALPHA = 1 / 8
+    _LQ_SNR_MIN = -7.5
+    _LQ_SNR_GOOD = 5.0
+
+
+    # Beacons come in the full and the hashed (compact) forms
+    _BCN_CMDS = (
+        lnk_heymac_cmd.HeymacCmdCsmaBcn,
+        lnk_heymac_cmd.HeymacCmdCsmaBcnHashed)
+    _BCN_CMD_IDS = tuple(cmd_cls.CMD_ID for cmd_cls in _BCN_CMDS)
+
+
+    def _process_bcn(self, ngbr, frame):
         """Process a Heymac beacon and keeps relevant link data."""
+        bcn = frame.cmd
         lnk_addr = frame.get_sender()
-        self._ngbr_data[lnk_addr] = {"BCN_CNT": 0}
-        # TODO: create and use _NGBR_FLD_* names
-        self._ngbr_data[lnk_addr]["BCN_FRAME"] = frame
-        self._ngbr_data[lnk_addr]["BCN_CNT"] += 1
+        is_bidir = bcn.has_ngbr(self._lnk_addr)
+        if is_bidir != (lnk_addr in self._bidir_ngbrs):
+            if is_bidir:
+                self._bidir_ngbrs.add(lnk_addr)
+            else:
+                self._bidir_ngbrs.discard(lnk_addr)
+            self._mprs = None
+        # Only the full beacon lists its neighbors' link addresses
+        hashed = type(bcn) is lnk_heymac_cmd.HeymacCmdCsmaBcnHashed
+        ngbrs = bcn.get_ngbr_hashes() if hashed else bcn.get_ngbrs()
+        old_listed = LnkData._get_listed_ngbrs(ngbr)
+        new_listed = frozenset() if hashed else ngbrs
+        if old_listed != new_listed:
+            self._index_two_hop(lnk_addr, old_listed, new_listed)
+        nets = bcn.get_field(lnk_heymac_cmd.HeymacCmd.FLD_NETS)
+        if ngbr.nets != nets:
+            self._gen += 1
+            self._index_nets(frame.get_sender(), ngbr.nets, nets)
+        # Update the beacon reception ratio: each beacon that should
+        # have been heard since the previous one is a miss (a zero)
+        # and this beacon is a hit (a one)
+        rx_tm = frame.rx_meta[0]
+        if ngbr.bcn_prr is None:
+            ngbr.bcn_prr = 1.0
+        else:
+            expected = max(1, round((rx_tm - ngbr.bcn_rx_tm) / self._bcn_prd))
+            ngbr.bcn_prr = ngbr.bcn_prr \
+                * (1 - LnkData._LQ_ALPHA) ** expected + LnkData._LQ_ALPHA
+        ngbr.bcn_cnt += 1
+        ngbr.bcn_rx_tm = rx_tm
+        caps = bcn.get_field(lnk_heymac_cmd.HeymacCmd.FLD_CAPS)
+        if ngbr.caps != caps:
+            self._gen += 1
+        ngbr.caps = caps
+        ngbr.nets = nets
+        ngbr.ngbrs = ngbrs
+        ngbr.ngbrs_hashed = hashed
+
+
+    def _index_nets(self, ngbr_addr, old_nets, new_nets):
+        """Updates the net index for the neighbor that advertised
+        old_nets and now advertises new_nets (either may be None).
+        """
+        old_nets = set(old_nets or ())
+        new_nets = set(new_nets or ())
+        for net_id, root in old_nets - new_nets:
+            roots = self._net_index[net_id]
+            roots[root].discard(ngbr_addr)
+            if not roots[root]:
+                del roots[root]
+                if not roots:
+                    del self._net_index[net_id]
+        for net_id, root in new_nets - old_nets:
+            self._net_index.setdefault(net_id, {}) \
+                .setdefault(root, set()).add(ngbr_addr)
+
 
-        # TODO: process nets[] to build list of known nets
+    def _index_two_hop(self, ngbr_addr, old_listed, new_listed):
+        """Updates the 2-hop topology for the neighbor whose beacon
+        listed the nodes in old_listed and now lists those in new_listed.
+        """
+        for lnk_addr in old_listed:
+            if lnk_addr not in new_listed:
+                cvrs = self._two_hop[lnk_addr]
+                cvrs.discard(ngbr_addr)
+                if not cvrs:
+                    del self._two_hop[lnk_addr]
+        for lnk_addr in new_listed:
+            if lnk_addr not in old_listed:
+                self._two_hop.setdefault(lnk_addr, set()).add(ngbr_addr)
+        self._mprs = None
+
+
+    @staticmethod
+    def _get_listed_ngbrs(ngbr):
+        """Returns the set of link addresses listed in the neighbor's
+        latest beacon.  A hashed beacon (or no beacon) gives an empty set.
+        """
+        if ngbr.ngbrs is None or ngbr.ngbrs_hashed:
+            return frozenset()
+        return ngbr.ngbrs
+
+
+    def _mk_mprs(self,):
+        """Returns the multipoint relays for the current topology.
+
+        Uses the greedy heuristic of OLSR (RFC 3626, 8.3.1):
+        first the neighbors that are the only cover of a 2-hop
+        neighbor, then the neighbor covering the most 2-hop neighbors
+        not yet covered (ties go to the better link) until all are.
+        Only bidirectional neighbors can be relays.
+        """
+        cvrs_of = {}
+        for lnk_addr in self.get_two_hop_ngbrs():
+            cvrs = self._two_hop[lnk_addr] & self._bidir_ngbrs
+            if cvrs:
+                cvrs_of[lnk_addr] = cvrs
+        mprs = set()
+        for cvrs in cvrs_of.values():
+            if len(cvrs) == 1:
+                mprs.update(cvrs)
+        uncovered = [lnk_addr for lnk_addr, cvrs in cvrs_of.items()
+                     if cvrs.isdisjoint(mprs)]
+        while uncovered:
+            reach = {}
+            for lnk_addr in uncovered:
+                for cvr in cvrs_of[lnk_addr]:
+                    reach[cvr] = reach.get(cvr, 0) + 1
+            mpr = max(reach, key=lambda cvr: (
+                reach[cvr], self.get_link_quality(cvr) or 0.0, cvr))
+            mprs.add(mpr)
+            uncovered = [lnk_addr for lnk_addr in uncovered
+                         if mpr not in cvrs_of[lnk_addr]]
+        return frozenset(mprs)
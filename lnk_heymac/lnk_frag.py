@@ -0,0 +1,103 @@
+"""
+Copyright 2020 Dean Hall.  See LICENSE for details.
+
+Link-layer (LNK) reassembly of datagrams sent in Heymac Fragments
+"""
+
+
+class _Reasm(object):
+    """A datagram being reassembled in one of the pool's buffers."""
+    __slots__ = ("buf", "dgram_sz", "frag_rngs", "rcvd_sz", "start_tm")
+
+    def __init__(self, buf, dgram_sz, start_tm):
+        self.buf = buf
+        self.dgram_sz = dgram_sz
+        # The (start, end) octet range of each fragment added
+        self.frag_rngs = []
+        self.rcvd_sz = 0
+        self.start_tm = start_tm
+
+
+class LnkFragReassembler(object):
+    """Reassembles datagrams from their fragments.
+
+    A fixed pool of buffers is allocated up front and each
+    datagram in progress, keyed by (sender, dgram_id), holds one buffer.
+    A fragment's data is copied straight to its offset in the buffer.
+    A datagram that is not complete within the timeout is dropped;
+    and when all buffers are in use, the oldest datagram is dropped
+    to make room for a new one.
+    """
+    def __init__(self, pool_sz, dgram_sz_max, timeout):
+        self._dgram_sz_max = dgram_sz_max
+        self._timeout = timeout
+        self._free_bufs = [bytearray(dgram_sz_max) for _ in range(pool_sz)]
+        # Datagrams in progress, oldest first (dicts keep insertion order)
+        self._reasms = {}
+
+
+    def add_frag(self, sender, dgram_id, dgram_sz, frag_off, frag, now):
+        """Adds the fragment of the datagram from the sender.
+
+        Returns the datagram as a memoryview when its last fragment
+        is added, otherwise returns None.  The memoryview is of a pooled
+        buffer; it is valid until the next call to add_frag(), so
+        a caller that keeps the datagram must copy it.
+
+        A fragment that does not fit the datagram
+        (or a datagram that is too large) is ignored.
+        So is a fragment that overlaps one already added (a duplicate):
+        a datagram completes only when each of its octets has been
+        written by exactly one fragment, so no stale data from the
+        buffer's previous datagram is returned.
+        """
+        self._expire(now)
+        if dgram_sz > self._dgram_sz_max or frag_off + len(frag) > dgram_sz \
+                or not frag:
+            return None
+
+        key = (sender, dgram_id)
+        reasm = self._reasms.get(key)
+        if reasm is not None and reasm.dgram_sz != dgram_sz:
+            # The sender has reused the dgram_id for a new datagram
+            self._free(key)
+            reasm = None
+        if reasm is None:
+            if not self._free_bufs:
+                self._free(next(iter(self._reasms)))
+            reasm = _Reasm(self._free_bufs.pop(), dgram_sz, now)
+            self._reasms[key] = reasm
+
+        frag_end = frag_off + len(frag)
+        for start, end in reasm.frag_rngs:
+            if frag_off < end and start < frag_end:
+                return None
+        reasm.frag_rngs.append((frag_off, frag_end))
+        reasm.buf[frag_off:frag_end] = frag
+        reasm.rcvd_sz += len(frag)
+
+        if reasm.rcvd_sz < dgram_sz:
+            return None
+        self._free(key)
+        return memoryview(reasm.buf)[:dgram_sz]
+
+
+    def get_pending_cnt(self,):
+        """Returns the number of datagrams being reassembled."""
+        return len(self._reasms)
+
+
+# Private
+
+
+    def _expire(self, now):
+        """Drops the datagrams that have not completed in time."""
+        expired = [key for key, reasm in self._reasms.items()
+                   if now > reasm.start_tm + self._timeout]
+        for key in expired:
+            self._free(key)
+
+
+    def _free(self, key):
+        """Drops the datagram and returns its buffer to the pool."""
+        self._free_bufs.append(self._reasms.pop(key).buf)
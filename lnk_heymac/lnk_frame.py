@@ -4,11 +4,66 @@ Copyright 2020 Dean Hall.  See LICENSE file for details.
 Link-layer Heymac frame parsing, building and serializing.
 """
 
+import collections
+import hashlib
+import hmac
+
+from . import lnk_heymac_cmd
+
+try:
+    import numpy as np
+except ImportError:
+    # NumPy is optional; only parse_columnar() needs it
+    np = None
+
 
 class HeymacFrameError(Exception):
     pass
 
 
+class _MicCtxCache(object):
+    """A bounded, least-recently-used cache of keyed HMAC-SHA256 objects.
+
+    Each key's HMAC object is made once and copied for each frame
+    instead of re-keying an HMAC per frame.
+    """
+    def __init__(self, max_sz):
+        self._max_sz = max_sz
+        self._ctxs = collections.OrderedDict()
+
+
+    def get(self, key):
+        """Returns the keyed HMAC object for the key.
+        The caller must copy, not update, the object.
+        """
+        key = bytes(key)
+        ctx = self._ctxs.get(key)
+        if ctx is None:
+            ctx = hmac.new(key, digestmod=hashlib.sha256)
+            self._ctxs[key] = ctx
+            if len(self._ctxs) > self._max_sz:
+                self._ctxs.popitem(last=False)
+        else:
+            self._ctxs.move_to_end(key)
+        return ctx
+
+
+# The field layout of a frame for one value of Fctl.
+# addr_sz is the size of each address field,
+# hdr_sz is the fixed header length (PID, Fctl, NetId, DstAddr, SrcAddr),
+# hdr_flds is the names of the header fields in serialization order,
+# hdr_offsets maps each fixed-size header field name to its (start, end)
+# offsets when no IEs are present (IEs shift SrcAddr by their size),
+# ies_off is the offset of the IEs field (None if IEs are not present),
+# flds is the names of the fields after Fctl that the frame may have,
+# mhop_sz is the size of the Hops and TxAddr fields at the frame's tail and
+# fctl_err is an error message if the Fctl value alone makes a frame invalid.
+_FrameLayout = collections.namedtuple(
+    "_FrameLayout",
+    ("addr_sz", "hdr_sz", "hdr_flds", "hdr_offsets", "ies_off", "flds",
+     "mhop_sz", "fctl_err"))
+
+
 class HeymacFrame(object):
     """Heymac frame definition
     [PID,Fctl,NetId,DstAddr,IEs,SrcAddr,Payld,MIC,Hops,TxAddr]
@@ -41,6 +96,14 @@ class HeymacFrame(object):
     00000001    P: Pending frame follows
     =========   ======================================
 
+    IEs := Information Elements
+
+    Each IE is a type octet, a length octet and that many octets of body.
+    The IEs field ends with an IE_TERM octet (which has no length or body).
+    The first body octet of an IE_MIC is the size of the MIC field.
+    Parsing scans only the IE headers; an IE's body is copied out
+    of the frame when get_ie() asks for it.
+
     There are two ways to use this class:
     to build a HeymacFrame object by setting fields
     and to parse a sequence of bytes yielding HeymacFrame object.
@@ -71,6 +134,9 @@ class HeymacFrame(object):
     PID_TYPE_TDMA = 0b00000000
     PID_TYPE_CSMA = 0b00000100
 
+    # The largest serialized frame, in octets
+    FRAME_SZ_MAX = 256
+
     # Frame Control (Fctl) subfields
     FCTL_X = 0b10000000     # eXtended frame (none of the other bits apply)
     FCTL_L = 0b01000000     # Long addressing
@@ -81,6 +147,10 @@ class HeymacFrame(object):
     FCTL_M = 0b00000010     # Multihop fields present
     FCTL_P = 0b00000001     # Pending frame follows
 
+    # Information Element (IE) types
+    IE_TERM = 0             # Terminates the IEs field
+    IE_MIC = 1              # MIC info: [mic_sz]
+
     # Frame field names
     FLD_PID = "pid"         # Protocol ID
     FLD_FCTL = "fctl"       # Frame Control
@@ -93,135 +163,242 @@ class HeymacFrame(object):
     FLD_HOPS = "hops"       # Hops remaining
     FLD_TADDR = "taddr"     # (re)Transmitter address
 
+    # Fixed attributes keep the per-frame memory small
+    # (many frames are held at once by a busy node)
+    __slots__ = (
+        "_pid", "_fctl", "_netid", "_daddr", "_ies", "_saddr",
+        "_payld", "_mic", "_hops", "_taddr",
+        "rx_meta", "_cmd", "_buf", "_payld_end", "_ies_sz", "_ie_index",
+        "_bytes")
 
     def __init__(self, pid, fctl):
         """Creates a HeymacFrame starting with the given PID and Fctl."""
         # Validate arguments
-        if (pid & HeymacFrame._PID_IDENT_MASK) != HeymacFrame.PID_IDENT_HEYMAC:
-            raise HeymacFrameError("PID field is not Heymac")
-        if (pid & HeymacFrame._PID_TYPE_MASK) not in \
-                (HeymacFrame.PID_TYPE_TDMA, HeymacFrame.PID_TYPE_CSMA):
-            raise HeymacFrameError("Heymac protocol type not supported")
+        err_msg = HeymacFrame._check_pid(pid)
+        if err_msg:
+            raise HeymacFrameError(err_msg)
 
-        self.field = {}
-        self.field[HeymacFrame.FLD_PID] = pid
-        self.field[HeymacFrame.FLD_FCTL] = fctl
+        self._pid = pid
+        self._fctl = fctl
+        self._netid = None
+        self._daddr = None
+        self._ies = None
+        self._saddr = None
+        self._payld = None
+        self._mic = None
+        self._hops = None
+        self._taddr = None
+
+        # Reception meta-data (set by the LNK layer)
+        # and the Heymac command (decoded on first access of cmd)
+        self.rx_meta = None
+        self._cmd = HeymacFrame._CMD_UNDECODED
+
+        # Receive buffer, end of payload, size of the IEs field
+        # and the IE index of a lazily parsed frame
+        self._buf = None
+        self._payld_end = 0
+        self._ies_sz = 0
+        self._ie_index = None
+
+        # Cached serialized frame (cleared by set_field())
+        self._bytes = None
 
 
     def __bytes__(self,):
         """Returns the HeymacFrame serialized into a bytes object.
 
+        The serialized form is cached until the next set_field().
+
         Raises a HeymacFrameError if some bits and fields
         are not set properly.
         """
-        self._validate_fctl_and_fields()
+        if self._bytes is None and self._buf is not None:
+            self._bytes = bytes(self._buf)
+        elif self._bytes is None:
+            self._validate_fctl_and_fields()
+            frame = bytearray(self._get_sz())
+            self._pack_fields(frame, 0)
+            self._bytes = bytes(frame)
+        return self._bytes
+
 
-        frame = bytearray()
-        frame.append(self.field[HeymacFrame.FLD_PID])
-        frame.append(self.field[HeymacFrame.FLD_FCTL])
+    def pack_into(self, buf, offset=0):
+        """Serializes the HeymacFrame into the writable buffer, buf,
+        (such as a bytearray) starting at the given offset.
+        Returns the number of bytes written.
 
-        if self.is_extended():
-            if HeymacFrame.FLD_PAYLD in self.field:
-                frame.extend(self.field[HeymacFrame.FLD_PAYLD])
+        Unlike __bytes__(), this does not allocate a new object.
+
+        Raises a HeymacFrameError if some bits and fields
+        are not set properly or if buf is too small.
+        """
+        src = self._bytes if self._bytes is not None else self._buf
+        frame_sz = self._get_packed_sz()
+        if offset + frame_sz > len(buf):
+            raise HeymacFrameError("Buffer is too small for the frame")
+        if src is not None:
+            buf[offset:offset + frame_sz] = src
         else:
-            if self.is_netid_present():
-                frame.extend(self.field[HeymacFrame.FLD_NETID])
-            if self.is_daddr_present():
-                frame.extend(self.field[HeymacFrame.FLD_DADDR])
-            # TODO: add IEs
-            if self.is_saddr_present():
-                frame.extend(self.field[HeymacFrame.FLD_SADDR])
-            if HeymacFrame.FLD_PAYLD in self.field:
-                frame.extend(self.field[HeymacFrame.FLD_PAYLD])
-            # TODO: add MICs
-            if self.is_mhop():
-                frame.append(self.field[HeymacFrame.FLD_HOPS])
-                frame.extend(self.field[HeymacFrame.FLD_TADDR])
-
-        if len(frame) > 256:
-            raise HeymacFrameError("Serialized frame is too large.")
-        return bytes(frame)
+            self._pack_fields(buf, offset)
+        return frame_sz
+
+
+    def mk_relay(self, taddr):
+        """Returns this multihop frame, serialized as it is to be relayed,
+        in a new bytearray: the Hops field is decremented and
+        the TxAddr field is replaced by the given taddr.
+        This frame is not modified.
+
+        Hops and TxAddr are always at the end of the frame, so the
+        frame is packed once into the new bytearray (see pack_into())
+        and its tail is patched in place.
+
+        Raises a HeymacFrameError if no hops remain.
+        """
+        lyt = HeymacFrame._LAYOUT[self._fctl]
+        assert lyt.mhop_sz, "Frame is not multihop"
+        assert len(taddr) == lyt.addr_sz
+        relay = bytearray(self._get_packed_sz())
+        self.pack_into(relay)
+        hops_offset = len(relay) - lyt.mhop_sz
+        if relay[hops_offset] == 0:
+            raise HeymacFrameError("No hops remain to relay the frame")
+        relay[hops_offset] -= 1
+        relay[hops_offset + 1:] = taddr
+        return relay
+
+
+    def copy_with_payld(self, payld):
+        """Returns a new frame with this frame's fields and reception
+        meta-data, but with the given payload.
+
+        This is how the LNK layer delivers each command of an aggregate
+        as a frame of its own.  The copy's MIC field (if any) is this
+        frame's and does not cover the new payload.
+        """
+        frame = HeymacFrame(self._pid, self._fctl)
+        for fld_nm in HeymacFrame._LAZY_FLDS:
+            if fld_nm != HeymacFrame.FLD_PAYLD:
+                setattr(frame, HeymacFrame._FLD_SLOT[fld_nm],
+                        self.get_field(fld_nm))
+        frame._payld = payld
+        frame.rx_meta = self.rx_meta
+        return frame
+
+
+    def add_mic(self, key, mic_sz=8):
+        """Adds a Message Integrity Code to this frame.
+
+        The MIC is the first mic_sz bytes of an HMAC-SHA256, using the
+        given key, of the frame from the PID through the payload.
+        The Hops and TxAddr fields are not covered, so a relayed frame
+        keeps a valid MIC.  An IE_MIC giving mic_sz is put in the IEs,
+        so the frame must have been created with FCTL_I set.
+        """
+        assert self.is_ies_present(), "MIC requires FCTL_I"
+        assert 0 < mic_sz <= hashlib.sha256().digest_size
+        ies = tuple(ie for ie in (self.get_field(HeymacFrame.FLD_IES) or ())
+                    if ie[0] != HeymacFrame.IE_MIC)
+        self.set_field(HeymacFrame.FLD_IES,
+                       ies + ((HeymacFrame.IE_MIC, bytes((mic_sz,))),))
+        self.set_field(HeymacFrame.FLD_MIC, bytes(mic_sz))
+        self.set_field(HeymacFrame.FLD_MIC,
+                       self._calc_mic(HeymacFrame._MIC_CTXS.get(key)))
+
+
+    def verify_mic(self, key):
+        """Returns True if this frame has a MIC and it is valid
+        for the given key.
+        """
+        return self._verify_mic_with(HeymacFrame._MIC_CTXS.get(key))
 
 
     @staticmethod
-    def parse(frame_bytes):
+    def parse(frame_bytes, lazy=False, trusted=False):
         """Parses the given frame_bytes and returns a HeymacFrame.
 
+        If lazy is True, frame_bytes is wrapped in a memoryview and
+        only the offsets of the fields are recorded.  A field's value
+        is copied out of the buffer on its first get_field() access.
+        The caller must not modify frame_bytes while the frame is in use.
+
+        If trusted is True, frame_bytes must be a bytes-like object
+        (such as a frame from the CRC-checked PHY) and only the checks
+        that the frame's layout needs are done: the PID, the Fctl value
+        (including the rules on Fctl alone, such as a long address
+        needing a DstAddr, SrcAddr or TxAddr field) and the frame's
+        length.  Each field named by Fctl is then present by
+        construction.  A lazy parse is always trusted.
+
         Raises a HeymacFrameError if some bits and fields
         are not set properly.
         """
-        assert 0 <= max(frame_bytes) <= 255, \
-            "frame_bytes must be a sequence of bytes"
+        if not lazy and not trusted:
+            assert 0 <= max(frame_bytes) <= 255, \
+                "frame_bytes must be a sequence of bytes"
 
-        if len(frame_bytes) < 2:
-            raise HeymacFrameError("Frame must be 2 or more bytes in length")
-        pid = frame_bytes[0]
-        fctl = frame_bytes[1]
-        frame = HeymacFrame(pid, fctl)
-        addr_sz = frame._get_addr_sz()
-        offset = 2
+        frame, err_msg = HeymacFrame._decode(frame_bytes, lazy, trusted)
+        if err_msg:
+            raise HeymacFrameError(err_msg)
+        return frame
 
-        # Format of Extended frame is not defined by Heymac
-        # so everything after PID, Fctl is payload
-        if frame.is_extended():
-            frame.set_field(HeymacFrame.FLD_PAYLD, frame_bytes[offset:])
-            offset = len(frame_bytes)
 
-        # Parse a regular Heymac frame
-        else:
-            if frame.is_netid_present():
-                frame.set_field(
-                    HeymacFrame.FLD_NETID,
-                    frame_bytes[offset:offset + 2])
-                offset += 2
-
-            if frame.is_daddr_present():
-                frame.set_field(
-                    HeymacFrame.FLD_DADDR,
-                    frame_bytes[offset:offset + addr_sz])
-                offset += addr_sz
-
-            # TODO: parse IEs
-
-            if frame.is_saddr_present():
-                frame.set_field(
-                    HeymacFrame.FLD_SADDR,
-                    frame_bytes[offset:offset + addr_sz])
-                offset += addr_sz
-
-            # Determine the size of the items at the tail
-            # of the frame in order to parse the payload
-            # TODO: determine MIC size from IEs
-            mic_sz = 0
-
-            if frame.is_mhop():
-                mhop_sz = 1 + addr_sz
+    @staticmethod
+    def parse_many(frames, lazy=False, trusted=False):
+        """Parses a batch of frames and returns a tuple: (frames, errors).
+
+        The frames argument is either a sequence of frames (each a
+        sequence of bytes) or a single bytes-like buffer of frames where
+        each frame is preceded by its length as a 16-bit big-endian int.
+        The lazy and trusted arguments have the same meaning as in parse().
+
+        The returned frames is a list with one item per input frame;
+        the item is None if that frame is not valid.  The returned errors
+        is a list of (index, HeymacFrameError) for each invalid frame.
+        Frames are validated by the same rules as parse(), but an invalid
+        frame does not raise an exception.
+        """
+        if isinstance(frames, (bytes, bytearray, memoryview)):
+            frames = HeymacFrame._split_length_prefixed(frames)
+        parsed = []
+        errors = []
+        for i, frame_bytes in enumerate(frames):
+            if frame_bytes is None:
+                frame, err_msg = None, "Frame length exceeds the buffer"
             else:
-                mhop_sz = 0
-
-            payld_sz = len(frame_bytes) - offset - mic_sz - mhop_sz
-            assert payld_sz >= 0
-            if payld_sz > 0:
-                frame.set_field(
-                    HeymacFrame.FLD_PAYLD,
-                    frame_bytes[offset:offset + payld_sz])
-                offset += payld_sz
-
-            # TODO: parse MIC
+                frame, err_msg = HeymacFrame._decode(
+                    frame_bytes, lazy, trusted)
+            if err_msg:
+                frame = None
+                errors.append((i, HeymacFrameError(err_msg)))
+            parsed.append(frame)
+        return parsed, errors
 
-            if frame.is_mhop():
-                frame.set_field(HeymacFrame.FLD_HOPS, frame_bytes[offset])
-                offset += 1
-                frame.set_field(
-                    HeymacFrame.FLD_PAYLD,
-                    frame_bytes[offset:offset + addr_sz])
-                offset += addr_sz
 
-        # Expected the amount parsed to match the frame size
-        assert offset == len(frame_bytes)
+    @staticmethod
+    def verify_mics(frames, get_key):
+        """Verifies the MIC of each frame in a batch.
 
-        frame._validate_fctl_and_fields()
-        return frame
+        The get_key argument is a callable that returns the key for a
+        frame (usually by its sender) or None if there is no key.
+        Returns a list with True for each frame whose MIC is valid.
+        Frames with the same key share one cached key context.
+        """
+        ctxs = {}
+        results = []
+        for frame in frames:
+            key = get_key(frame)
+            if key is None:
+                results.append(False)
+                continue
+            key = bytes(key)
+            ctx = ctxs.get(key)
+            if ctx is None:
+                ctx = HeymacFrame._MIC_CTXS.get(key)
+                ctxs[key] = ctx
+            results.append(frame._verify_mic_with(ctx))
+        return results
 
 
     def get_field(self, fld_nm):
@@ -233,14 +410,33 @@ class HeymacFrame(object):
             HeymacFrame.FLD_FCTL,
             HeymacFrame.FLD_NETID,
             HeymacFrame.FLD_DADDR,
-            # HeymacFrame.FLD_IES,   # IEs are not yet supported
+            HeymacFrame.FLD_IES,
             HeymacFrame.FLD_SADDR,
             HeymacFrame.FLD_PAYLD,
-            # HeymacFrame.FLD_MIC,   # MICs are not yet supported
+            HeymacFrame.FLD_MIC,
             HeymacFrame.FLD_HOPS,
             HeymacFrame.FLD_TADDR,
         )
-        return self.field.get(fld_nm, None)
+        value = getattr(self, HeymacFrame._FLD_SLOT[fld_nm])
+        if value is None and self._buf is not None:
+            value = self._materialize_field(fld_nm)
+        return value
+
+
+    def get_ie(self, ie_type):
+        """Returns the body of the first IE of the given type.
+        Returns None if the frame has no such IE.
+        A lazily parsed frame copies out only that IE's body.
+        """
+        if self._ies is not None:
+            for typ, body in self._ies:
+                if typ == ie_type:
+                    return body
+        elif self._buf is not None and self._ie_index:
+            for typ, body_start, body_sz in self._ie_index:
+                if typ == ie_type:
+                    return bytes(self._buf[body_start:body_start + body_sz])
+        return None
 
 
     def get_sender(self,):
@@ -252,44 +448,92 @@ class HeymacFrame(object):
         return sender
 
 
+    @property
+    def cmd(self,):
+        """The Heymac command in the payload, or None if the payload
+        is absent or is not a valid Heymac command.
+
+        The payload is decoded on the first access and the result
+        (including a failure) is kept, so a frame that is only
+        forwarded or dropped never pays for decoding.
+        """
+        if self._cmd is HeymacFrame._CMD_UNDECODED:
+            cmd = None
+            payld = self.get_field(HeymacFrame.FLD_PAYLD)
+            if payld:
+                try:
+                    cmd = lnk_heymac_cmd.HeymacCmd.parse(bytes(payld))
+                except lnk_heymac_cmd.HeymacCmdError:
+                    pass
+            self._cmd = cmd
+        return self._cmd
+
+
+    @cmd.setter
+    def cmd(self, cmd):
+        self._cmd = cmd
+
+
+    def get_cmd_id(self,):
+        """Returns the CMD_ID of the Heymac command in the payload
+        or None if the payload does not start with a command prefix.
+
+        This peeks at the first payload octet without decoding the
+        command (or copying the payload out of a lazily parsed frame).
+        """
+        if self._payld is not None:
+            first = self._payld[0] if self._payld else None
+        elif self._buf is not None:
+            payld_start = HeymacFrame._LAYOUT[self._fctl].hdr_sz \
+                + self._ies_sz
+            first = self._buf[payld_start] \
+                if payld_start < self._payld_end else None
+        else:
+            first = None
+        cmd_cls = lnk_heymac_cmd.HeymacCmd
+        if first is None or first & cmd_cls.PREFIX_MASK != cmd_cls.PREFIX:
+            return None
+        return first & cmd_cls.CMD_MASK
+
+
     def is_heymac(self,):
         """Returns True if the PID Ident subfield indicates Heymac protocol.
         Note, this only checks the first four bits and does not check
         the rest of the frame for validity.
         """
-        return (self.field[HeymacFrame.FLD_PID] & HeymacFrame._PID_IDENT_MASK
+        return (self._pid & HeymacFrame._PID_IDENT_MASK
                 == HeymacFrame.PID_IDENT_HEYMAC)
 
     def is_extended(self,):
-        return 0 != (self.field[HeymacFrame.FLD_FCTL] & HeymacFrame.FCTL_X)
+        return 0 != (self._fctl & HeymacFrame.FCTL_X)
 
     def is_long_addrs(self,):
-        return (0 == (self.field[HeymacFrame.FLD_FCTL] & HeymacFrame.FCTL_X)
-            and 0 != (self.field[HeymacFrame.FLD_FCTL] & HeymacFrame.FCTL_L))
+        return (0 == (self._fctl & HeymacFrame.FCTL_X)
+            and 0 != (self._fctl & HeymacFrame.FCTL_L))
 
     def is_netid_present(self,):
-        return (0 == (self.field[HeymacFrame.FLD_FCTL] & HeymacFrame.FCTL_X)
-            and 0 != (self.field[HeymacFrame.FLD_FCTL] & HeymacFrame.FCTL_N))
+        return (0 == (self._fctl & HeymacFrame.FCTL_X)
+            and 0 != (self._fctl & HeymacFrame.FCTL_N))
 
     def is_daddr_present(self,):
-        return (0 == (self.field[HeymacFrame.FLD_FCTL] & HeymacFrame.FCTL_X)
-            and 0 != (self.field[HeymacFrame.FLD_FCTL] & HeymacFrame.FCTL_D))
+        return (0 == (self._fctl & HeymacFrame.FCTL_X)
+            and 0 != (self._fctl & HeymacFrame.FCTL_D))
 
     def is_ies_present(self,):
-        return (0 == (self.field[HeymacFrame.FLD_FCTL] & HeymacFrame.FCTL_X)
-            and 0 != (self.field[HeymacFrame.FLD_FCTL] & HeymacFrame.FCTL_I))
+        return (0 == (self._fctl & HeymacFrame.FCTL_X)
+            and 0 != (self._fctl & HeymacFrame.FCTL_I))
 
     def is_saddr_present(self,):
-        return (0 == (self.field[HeymacFrame.FLD_FCTL] & HeymacFrame.FCTL_X)
-            and 0 != (self.field[HeymacFrame.FLD_FCTL] & HeymacFrame.FCTL_S))
+        return (0 == (self._fctl & HeymacFrame.FCTL_X)
+            and 0 != (self._fctl & HeymacFrame.FCTL_S))
 
     def is_mhop(self,):
-        return (0 == (self.field[HeymacFrame.FLD_FCTL] & HeymacFrame.FCTL_X)
-            and 0 != (self.field[HeymacFrame.FLD_FCTL] & HeymacFrame.FCTL_M))
+        return (0 == (self._fctl & HeymacFrame.FCTL_X)
+            and 0 != (self._fctl & HeymacFrame.FCTL_M))
 
     def is_pending_set(self,):
-        return (0 == (self.field[HeymacFrame.FLD_FCTL] & HeymacFrame.FCTL_X)
-            and 0 != (self.field[HeymacFrame.FLD_FCTL] & HeymacFrame.FCTL_P))
+        return (0 == (self._fctl & HeymacFrame.FCTL_X)
+            and 0 != (self._fctl & HeymacFrame.FCTL_P))
 
 
     def set_field(self, fld_nm, value):
@@ -300,10 +544,10 @@ class HeymacFrame(object):
             # HeymacFrame.FLD_FCTL,  # Can only set this in the constructor
             HeymacFrame.FLD_NETID,
             HeymacFrame.FLD_DADDR,
-            # HeymacFrame.FLD_IES,   # IEs are not yet supported
+            HeymacFrame.FLD_IES,
             HeymacFrame.FLD_SADDR,
             HeymacFrame.FLD_PAYLD,
-            # HeymacFrame.FLD_MIC,   # MICs are not yet supported
+            HeymacFrame.FLD_MIC,
             HeymacFrame.FLD_HOPS,
             HeymacFrame.FLD_TADDR,
         ), "Field '{}' cannot be set by set_field()".format(fld_nm)
@@ -330,8 +574,24 @@ class HeymacFrame(object):
         elif fld_nm == HeymacFrame.FLD_TADDR:
             assert self.is_mhop()
 
+        # IEs are a sequence of (ie_type, body)
+        if fld_nm == HeymacFrame.FLD_IES:
+            value = tuple((ie_type, bytes(body)) for ie_type, body in value)
+            for ie_type, body in value:
+                assert 0 < ie_type <= 255, "Invalid IE type"
+                assert len(body) <= 255, "IE body is too large"
+
+        # A lazily parsed frame's buffer holds the frame exactly as
+        # it was parsed, so copy out the fields before one changes
+        if self._buf is not None:
+            self._materialize_fields()
+            self._buf = None
+
         # Store the field
-        self.field[fld_nm] = value
+        setattr(self, HeymacFrame._FLD_SLOT[fld_nm], value)
+        self._bytes = None
+        if fld_nm == HeymacFrame.FLD_PAYLD:
+            self._cmd = HeymacFrame._CMD_UNDECODED
 
 
 # Private
@@ -341,12 +601,339 @@ class HeymacFrame(object):
     _PID_IDENT_MASK = 0b11110000
     _PID_TYPE_MASK = 0b00001111
 
+    # Keyed HMAC contexts for MICs, shared by all frames
+    _MIC_CTX_CACHE_SZ = 64
+    _MIC_CTXS = _MicCtxCache(_MIC_CTX_CACHE_SZ)
+
+    # The value of _cmd until the payload is decoded
+    _CMD_UNDECODED = object()
+
+    # Fctl bits that indicate a field is present (in a regular frame)
+    _FCTL_FLD_BITS = FCTL_N | FCTL_D | FCTL_I | FCTL_S | FCTL_M
+
+    # Each field is stored in a fixed attribute rather than a dict
+    _FLD_SLOT = {
+        FLD_PID: "_pid",
+        FLD_FCTL: "_fctl",
+        FLD_NETID: "_netid",
+        FLD_DADDR: "_daddr",
+        FLD_IES: "_ies",
+        FLD_SADDR: "_saddr",
+        FLD_PAYLD: "_payld",
+        FLD_MIC: "_mic",
+        FLD_HOPS: "_hops",
+        FLD_TADDR: "_taddr",
+    }
+
+    # Fields that a lazily parsed frame copies out of its buffer
+    _LAZY_FLDS = (FLD_NETID, FLD_DADDR, FLD_IES, FLD_SADDR, FLD_PAYLD,
+                  FLD_MIC, FLD_HOPS, FLD_TADDR)
+
     # TODO: verify CSMA version
     # _SUPPORTED_CSMA_VRSNS = (0,)
 
 
+    @staticmethod
+    def _check_pid(pid):
+        """Returns an error message if the PID is not supported, else None."""
+        if (pid & HeymacFrame._PID_IDENT_MASK) != HeymacFrame.PID_IDENT_HEYMAC:
+            return "PID field is not Heymac"
+        if (pid & HeymacFrame._PID_TYPE_MASK) not in \
+                (HeymacFrame.PID_TYPE_TDMA, HeymacFrame.PID_TYPE_CSMA):
+            return "Heymac protocol type not supported"
+        return None
+
+    @staticmethod
+    def _decode(frame_bytes, lazy, trusted):
+        """Decodes the frame_bytes into a HeymacFrame.
+
+        Returns a tuple: (frame, err_msg).  If the frame is not valid,
+        err_msg describes why and frame should not be used.
+        This is the codec shared by parse() and parse_many().
+        """
+        if len(frame_bytes) < 2:
+            return None, "Frame must be 2 or more bytes in length"
+        pid = frame_bytes[0]
+        fctl = frame_bytes[1]
+        err_msg = HeymacFrame._check_pid(pid)
+        if err_msg:
+            return None, err_msg
+        frame = HeymacFrame(pid, fctl)
+        lyt = HeymacFrame._LAYOUT[fctl]
+
+        # Index the IEs (only their headers are read)
+        # and get the MIC size from the index
+        mic_sz = 0
+        if lyt.ies_off is not None:
+            ie_index, ies_sz, err_msg = HeymacFrame._scan_ies(
+                frame_bytes, lyt.ies_off)
+            if err_msg:
+                return None, err_msg
+            mic_sz, err_msg = HeymacFrame._get_mic_sz_from_index(
+                frame_bytes, ie_index)
+            if err_msg:
+                return None, err_msg
+            frame._ie_index = ie_index
+            frame._ies_sz = ies_sz
+
+        # Determine the size of the items at the tail
+        # of the frame in order to find the end of the payload
+        payld_end = len(frame_bytes) - mic_sz - lyt.mhop_sz
+        if payld_end < lyt.hdr_sz + frame._ies_sz:
+            return None, "Frame is too short for its fields"
+        frame._payld_end = payld_end
+
+        # When trusted, the fields named by Fctl exist by construction,
+        # so only the Fctl-only rules of _check_fctl_and_fields() apply
+        # (precomputed in the layout)
+        if lazy or trusted:
+            if lyt.fctl_err:
+                return None, lyt.fctl_err
+        if lazy:
+            frame._buf = memoryview(frame_bytes)
+        else:
+            frame._buf = frame_bytes
+            frame._materialize_fields()
+            frame._buf = None
+            if not trusted:
+                err_msg = frame._check_fctl_and_fields()
+
+        # A valid frame serializes to the bytes it was parsed from
+        if type(frame_bytes) is bytes:
+            frame._bytes = frame_bytes
+        return frame, err_msg
+
+    @staticmethod
+    def _scan_ies(buf, offset):
+        """Scans the headers of the IEs field that starts at offset.
+
+        Returns a tuple: (ie_index, ies_sz, err_msg).
+        The ie_index is a tuple of (ie_type, body_start, body_sz)
+        for each IE and ies_sz is the size of the IEs field.
+        """
+        ie_index = []
+        start = offset
+        end = len(buf)
+        while offset < end:
+            ie_type = buf[offset]
+            if ie_type == HeymacFrame.IE_TERM:
+                return tuple(ie_index), offset + 1 - start, None
+            if offset + 2 > end:
+                break
+            body_sz = buf[offset + 1]
+            offset += 2
+            ie_index.append((ie_type, offset, body_sz))
+            offset += body_sz
+        return None, 0, "IEs field is not terminated"
+
+    @staticmethod
+    def _get_mic_sz_from_index(buf, ie_index):
+        """Returns a tuple: (mic_sz, err_msg) given the IE index."""
+        for ie_type, body_start, body_sz in ie_index:
+            if ie_type == HeymacFrame.IE_MIC:
+                if body_sz < 1:
+                    return 0, "MIC IE is missing the MIC size"
+                return buf[body_start], None
+        return 0, None
+
+    @staticmethod
+    def _split_length_prefixed(buf):
+        """Yields a memoryview of each frame in the buffer of
+        length-prefixed frames.  Yields None if the last frame
+        is truncated.
+        """
+        buf = memoryview(buf)
+        offset = 0
+        while offset < len(buf):
+            if offset + 2 > len(buf):
+                yield None
+                return
+            frame_sz = (buf[offset] << 8) | buf[offset + 1]
+            offset += 2
+            if offset + frame_sz > len(buf):
+                yield None
+                return
+            yield buf[offset:offset + frame_sz]
+            offset += frame_sz
+
+    def _calc_mic(self, ctx):
+        """Returns the MIC of this frame given the key's HMAC context.
+
+        Expects the MIC field to be present (and of the MIC's size).
+        """
+        mic_sz = len(self._mic if self._mic is not None
+                     else self.get_field(HeymacFrame.FLD_MIC))
+        if self._buf is not None:
+            data = self._buf[:self._payld_end]
+        else:
+            frame = bytes(self)
+            mhop_sz = HeymacFrame._LAYOUT[self._fctl].mhop_sz
+            data = memoryview(frame)[:len(frame) - mhop_sz - mic_sz]
+        h = ctx.copy()
+        h.update(data)
+        return h.digest()[:mic_sz]
+
+    def _verify_mic_with(self, ctx):
+        """Returns True if this frame's MIC is valid for the key's context."""
+        mic = self.get_field(HeymacFrame.FLD_MIC)
+        if not mic:
+            return False
+        return hmac.compare_digest(mic, self._calc_mic(ctx))
+
+    def _get_packed_sz(self,):
+        """Returns the size of the serialized frame,
+        validating the fields if the frame is not already serialized.
+        """
+        src = self._bytes if self._bytes is not None else self._buf
+        if src is not None:
+            return len(src)
+        self._validate_fctl_and_fields()
+        return self._get_sz()
+
+    def _get_sz(self,):
+        """Returns the size of the serialized frame.
+
+        Raises a HeymacFrameError if the frame is too large.
+        """
+        frame_sz = 2
+        for fld_nm in HeymacFrame._LAYOUT[self._fctl].hdr_flds:
+            if fld_nm == HeymacFrame.FLD_IES:
+                frame_sz += 1 + sum(2 + len(body) for _, body in self._ies)
+            else:
+                frame_sz += len(getattr(self, HeymacFrame._FLD_SLOT[fld_nm]))
+        if self._payld is not None:
+            frame_sz += len(self._payld)
+        if self._mic is not None:
+            frame_sz += len(self._mic)
+        if self._taddr is not None:
+            frame_sz += 1 + len(self._taddr)
+        if frame_sz > HeymacFrame.FRAME_SZ_MAX:
+            raise HeymacFrameError("Serialized frame is too large.")
+        return frame_sz
+
+    def _pack_fields(self, buf, offset):
+        """Writes the (validated) fields into buf starting at offset."""
+        lyt = HeymacFrame._LAYOUT[self._fctl]
+        buf[offset] = self._pid
+        buf[offset + 1] = self._fctl
+        offset += 2
+        for fld_nm in lyt.hdr_flds:
+            if fld_nm == HeymacFrame.FLD_IES:
+                for ie_type, body in self._ies:
+                    buf[offset] = ie_type
+                    buf[offset + 1] = len(body)
+                    buf[offset + 2:offset + 2 + len(body)] = body
+                    offset += 2 + len(body)
+                buf[offset] = HeymacFrame.IE_TERM
+                offset += 1
+            else:
+                value = getattr(self, HeymacFrame._FLD_SLOT[fld_nm])
+                buf[offset:offset + len(value)] = value
+                offset += len(value)
+        if self._payld is not None:
+            buf[offset:offset + len(self._payld)] = self._payld
+            offset += len(self._payld)
+        if self._mic is not None:
+            buf[offset:offset + len(self._mic)] = self._mic
+            offset += len(self._mic)
+        if lyt.mhop_sz:
+            buf[offset] = self._hops
+            buf[offset + 1:offset + lyt.mhop_sz] = self._taddr
+
     def _get_addr_sz(self,):
-        return (2, 8)[self.is_long_addrs()]
+        return HeymacFrame._LAYOUT[self._fctl].addr_sz
+
+    @staticmethod
+    def _mk_layout(fctl):
+        """Returns the _FrameLayout for the given Fctl value."""
+        if fctl & HeymacFrame.FCTL_X:
+            if fctl & HeymacFrame.FCTL_L:
+                fctl_err = \
+                    "Long address selected, but no address field is present"
+            elif fctl & HeymacFrame._FCTL_FLD_BITS:
+                fctl_err = "Fctl bit/value missing for extended frame"
+            else:
+                fctl_err = None
+            return _FrameLayout(
+                2, 2, (), {}, None, (HeymacFrame.FLD_PAYLD,), 0, fctl_err)
+        addr_sz = (2, 8)[0 != fctl & HeymacFrame.FCTL_L]
+        hdr_flds = []
+        hdr_offsets = {}
+        ies_off = None
+        offset = 2
+        for bit, fld_nm, fld_sz in (
+                (HeymacFrame.FCTL_N, HeymacFrame.FLD_NETID, 2),
+                (HeymacFrame.FCTL_D, HeymacFrame.FLD_DADDR, addr_sz),
+                (HeymacFrame.FCTL_I, HeymacFrame.FLD_IES, 0),
+                (HeymacFrame.FCTL_S, HeymacFrame.FLD_SADDR, addr_sz),):
+            if fctl & bit:
+                hdr_flds.append(fld_nm)
+                if fld_nm == HeymacFrame.FLD_IES:
+                    ies_off = offset
+                else:
+                    hdr_offsets[fld_nm] = (offset, offset + fld_sz)
+                offset += fld_sz
+        mhop_sz = (0, 1 + addr_sz)[0 != fctl & HeymacFrame.FCTL_M]
+        # A MIC is only present with a MIC IE
+        flds = hdr_flds + [HeymacFrame.FLD_PAYLD]
+        if ies_off is not None:
+            flds.append(HeymacFrame.FLD_MIC)
+        if mhop_sz:
+            flds.extend((HeymacFrame.FLD_HOPS, HeymacFrame.FLD_TADDR))
+        # NetId is not an address field
+        if fctl & HeymacFrame.FCTL_L and not mhop_sz \
+                and not fctl & (HeymacFrame.FCTL_D | HeymacFrame.FCTL_S):
+            fctl_err = "Long address selected, but no address field is present"
+        else:
+            fctl_err = None
+        return _FrameLayout(addr_sz, offset, tuple(hdr_flds), hdr_offsets,
+                            ies_off, tuple(flds), mhop_sz, fctl_err)
+
+    def _materialize_field(self, fld_nm):
+        """Copies the field's value out of the receive buffer
+        of a lazily parsed frame, stores it and returns it.
+        Returns None if the field is not present.
+        """
+        fctl = self._fctl
+        lyt = HeymacFrame._LAYOUT[fctl]
+        buf = self._buf
+        # The end of the MIC (or payload) is the start of the multihop tail
+        tail = len(buf) - lyt.mhop_sz
+        if fld_nm in lyt.hdr_offsets:
+            start, end = lyt.hdr_offsets[fld_nm]
+            # SrcAddr follows the IEs
+            if fld_nm == HeymacFrame.FLD_SADDR:
+                start += self._ies_sz
+                end += self._ies_sz
+            value = bytes(buf[start:end])
+        elif fld_nm == HeymacFrame.FLD_IES and self._ie_index is not None:
+            value = tuple((ie_type, bytes(buf[start:start + sz]))
+                          for ie_type, start, sz in self._ie_index)
+        elif fld_nm == HeymacFrame.FLD_PAYLD:
+            payld_start = lyt.hdr_sz + self._ies_sz
+            if self._payld_end == payld_start \
+                    and not fctl & HeymacFrame.FCTL_X:
+                return None
+            value = bytes(buf[payld_start:self._payld_end])
+        elif fld_nm == HeymacFrame.FLD_MIC and self._payld_end < tail:
+            value = bytes(buf[self._payld_end:tail])
+        elif fld_nm == HeymacFrame.FLD_HOPS and lyt.mhop_sz:
+            value = buf[tail]
+        elif fld_nm == HeymacFrame.FLD_TADDR and lyt.mhop_sz:
+            value = bytes(buf[tail + 1:])
+        else:
+            return None
+        setattr(self, HeymacFrame._FLD_SLOT[fld_nm], value)
+        return value
+
+    def _materialize_fields(self,):
+        """Copies all fields of a lazily parsed frame out of its buffer.
+        Only the fields that its Fctl allows are looked for.
+        """
+        if self._buf is not None:
+            for fld_nm in HeymacFrame._LAYOUT[self._fctl].flds:
+                if getattr(self, HeymacFrame._FLD_SLOT[fld_nm]) is None:
+                    self._materialize_field(fld_nm)
 
     def _validate_fctl_and_fields(self,):
         """Validates this HeymacFrame
@@ -355,35 +942,59 @@ class HeymacFrame(object):
         Fctl bits indicate a field is needed, but it's not present;
         or a field is present, but the Fctl bit is not set.
         """
+        err_msg = self._check_fctl_and_fields()
+        if err_msg:
+            raise HeymacFrameError(err_msg)
+
+    def _check_fctl_and_fields(self,):
+        """Checks this HeymacFrame by the rules described in
+        _validate_fctl_and_fields().
+        Returns an error message if the frame is not valid, else None.
+        """
         err_msg = None
-        if not err_msg and HeymacFrame.FLD_PID not in self.field:
+        if not err_msg and self._pid is None:
             err_msg = "PID value is missing"
-        if not err_msg and HeymacFrame.FLD_FCTL not in self.field:
+        if not err_msg and self._fctl is None:
             err_msg = "Fctl value is missing"
 
         # Check that if the bit is set in Fctl,
         # the data field exists and vice versa
         if not err_msg:
-            fctl = self.field[HeymacFrame.FLD_FCTL]
+            fctl = self._fctl
             for bit, field_nm in (
                     (HeymacFrame.FCTL_N, HeymacFrame.FLD_NETID),
                     (HeymacFrame.FCTL_D, HeymacFrame.FLD_DADDR),
-                    # (HeymacFrame.FCTL_I, HeymacFrame.FLD_IES), # TODO: IEs
+                    (HeymacFrame.FCTL_I, HeymacFrame.FLD_IES),
                     (HeymacFrame.FCTL_S, HeymacFrame.FLD_SADDR),
                     (HeymacFrame.FCTL_M, HeymacFrame.FLD_HOPS),
                     (HeymacFrame.FCTL_M, HeymacFrame.FLD_TADDR),):
-                if (bit & fctl and field_nm not in self.field) or \
-                   ((bit & fctl) == 0 and field_nm in self.field):
+                present = getattr(self, HeymacFrame._FLD_SLOT[field_nm]) \
+                    is not None
+                if (bit & fctl and not present) or \
+                   ((bit & fctl) == 0 and present):
                     err_msg = "Fctl bit/value missing for Fctl bit 0x{:x} " \
                               "and field '{}'".format(bit, field_nm)
                     break
 
         # Special cases
+        # The MIC must be the size given by the MIC IE
+        # (without IEs, there is no MIC IE to look up)
+        if not err_msg and not fctl & HeymacFrame.FCTL_I:
+            if self._mic is not None:
+                err_msg = "MIC size does not match the MIC IE"
+        elif not err_msg:
+            mic_ie = self.get_ie(HeymacFrame.IE_MIC)
+            mic_sz = mic_ie[0] if mic_ie else 0
+            if mic_ie is not None and not mic_ie:
+                err_msg = "MIC IE is missing the MIC size"
+            elif mic_sz != (len(self._mic) if self._mic is not None else 0):
+                err_msg = "MIC size does not match the MIC IE"
+
         # If FCTL_L is set, at least one address field must exist
         if not err_msg and (HeymacFrame.FCTL_L & fctl
-                and HeymacFrame.FLD_DADDR not in self.field
-                and HeymacFrame.FLD_SADDR not in self.field
-                and HeymacFrame.FLD_TADDR not in self.field):
+                and self._daddr is None
+                and self._saddr is None
+                and self._taddr is None):
             err_msg = "Long address selected, but no address field is present"
 
         # If FCTL_X is set, only the payload should exist
@@ -395,9 +1006,134 @@ class HeymacFrame(object):
                              HeymacFrame.FLD_MIC,
                              HeymacFrame.FLD_HOPS,
                              HeymacFrame.FLD_TADDR,):
-                if field_nm in self.field:
+                if getattr(self, HeymacFrame._FLD_SLOT[field_nm]) is not None:
                     err_msg = "Extended frame has field other than {}" \
                               .format(HeymacFrame.FLD_PAYLD)
                     break
-        if err_msg:
-            raise HeymacFrameError(err_msg)
+        return err_msg
+
+
+# Precompute the layout of every Fctl value so that frame
+# header decoding and encoding is a single table lookup
+HeymacFrame._LAYOUT = tuple(
+    HeymacFrame._mk_layout(fctl) for fctl in range(256))
+
+
+# Columns of the structured array returned by parse_columnar().
+# Address fields hold the address as a big-endian unsigned integer.
+# Offsets are from the start of the frame.  A field that is not present
+# in a frame is zero in its row.
+COLUMNAR_DTYPE = (
+    ("valid", "?"),
+    ("pid", "u1"),
+    ("fctl", "u1"),
+    ("netid", "u2"),
+    ("daddr", "u8"),
+    ("saddr", "u8"),
+    ("hops", "u1"),
+    ("taddr", "u8"),
+    ("payld_offset", "u2"),
+    ("payld_len", "u2"),
+)
+
+
+def parse_columnar(frames):
+    """Decodes the headers of a batch of frames into a NumPy structured array.
+
+    The frames argument is the same as for HeymacFrame.parse_many().
+    Returns an array with one row per frame and the columns given by
+    COLUMNAR_DTYPE.  Field presence and offsets are computed with
+    vectorized Fctl bit tests, so no HeymacFrame objects are created.
+    A row's "valid" column is False if the frame would not pass
+    HeymacFrame.parse(); its other columns (except PID, Fctl) are zero.
+
+    Raises ImportError if NumPy is not installed.
+    """
+    if np is None:
+        raise ImportError("parse_columnar() requires NumPy")
+
+    if isinstance(frames, (bytes, bytearray, memoryview)):
+        frames = [b"" if f is None else f
+                  for f in HeymacFrame._split_length_prefixed(frames)]
+    cnt = len(frames)
+    lens = np.fromiter(map(len, frames), dtype=np.int64, count=cnt)
+    starts = np.zeros(cnt, dtype=np.int64)
+    np.cumsum(lens[:-1], out=starts[1:])
+    # Pad the end so reads past a short frame stay in bounds
+    flat = np.frombuffer(b"".join(frames) + bytes(32), dtype=np.uint8)
+
+    pid = flat[starts]
+    fctl = flat[starts + 1]
+    reg = (fctl & HeymacFrame.FCTL_X) == 0
+    is_l = reg & ((fctl & HeymacFrame.FCTL_L) != 0)
+    is_n = reg & ((fctl & HeymacFrame.FCTL_N) != 0)
+    is_d = reg & ((fctl & HeymacFrame.FCTL_D) != 0)
+    is_i = reg & ((fctl & HeymacFrame.FCTL_I) != 0)
+    is_s = reg & ((fctl & HeymacFrame.FCTL_S) != 0)
+    is_m = reg & ((fctl & HeymacFrame.FCTL_M) != 0)
+    addr_sz = np.where(is_l, 8, 2)
+
+    netid_off = np.full(cnt, 2, dtype=np.int64)
+    daddr_off = netid_off + 2 * is_n
+    ies_off = daddr_off + addr_sz * is_d
+
+    # IEs are variable length, so only the rows that have them
+    # are scanned (in Python) for the IEs' size and the MIC size
+    ies_sz = np.zeros(cnt, dtype=np.int64)
+    mic_sz = np.zeros(cnt, dtype=np.int64)
+    ies_ok = np.ones(cnt, dtype=bool)
+    for i in np.flatnonzero(is_i & (lens >= 2)):
+        ie_index, ies_sz[i], err_msg = HeymacFrame._scan_ies(
+            frames[i], ies_off[i])
+        if not err_msg:
+            mic_sz[i], err_msg = HeymacFrame._get_mic_sz_from_index(
+                frames[i], ie_index)
+        ies_ok[i] = not err_msg
+
+    saddr_off = ies_off + ies_sz
+    hdr_sz = saddr_off + addr_sz * is_s
+    mhop_off = lens - is_m * (1 + addr_sz)
+    payld_end = mhop_off - mic_sz
+    payld_len = payld_end - hdr_sz
+
+    valid = lens >= 2
+    valid &= ((pid & HeymacFrame._PID_IDENT_MASK) ==
+              HeymacFrame.PID_IDENT_HEYMAC)
+    pid_type = pid & HeymacFrame._PID_TYPE_MASK
+    valid &= (pid_type == HeymacFrame.PID_TYPE_TDMA) \
+        | (pid_type == HeymacFrame.PID_TYPE_CSMA)
+    valid &= ies_ok
+    valid &= payld_len >= 0
+    fctl_ok = np.array(
+        [lyt.fctl_err is None for lyt in HeymacFrame._LAYOUT], dtype=bool)
+    valid &= fctl_ok[fctl]
+
+    cols = np.zeros(cnt, dtype=list(COLUMNAR_DTYPE))
+    cols["valid"] = valid
+    cols["pid"] = np.where(lens >= 1, pid, 0)
+    cols["fctl"] = np.where(lens >= 2, fctl, 0)
+    cols["netid"] = np.where(valid & is_n,
+                             _gather_be(flat, starts + netid_off, 2), 0)
+    cols["daddr"] = np.where(valid & is_d,
+                             _gather_be(flat, starts + daddr_off, addr_sz), 0)
+    cols["saddr"] = np.where(valid & is_s,
+                             _gather_be(flat, starts + saddr_off, addr_sz), 0)
+    tail = np.where(valid & is_m, starts + mhop_off, 0)
+    cols["hops"] = np.where(valid & is_m, flat[tail], 0)
+    cols["taddr"] = np.where(valid & is_m,
+                             _gather_be(flat, tail + 1, addr_sz), 0)
+    cols["payld_offset"] = np.where(valid, hdr_sz, 0)
+    cols["payld_len"] = np.where(valid, payld_len, 0)
+    return cols
+
+
+def _gather_be(flat, offsets, sz):
+    """Returns the big-endian unsigned integers of size sz (an int or
+    an array of ints no greater than 8) at the offsets in the flat array.
+    """
+    value = np.zeros(len(offsets), dtype=np.uint64)
+    sz = np.broadcast_to(sz, value.shape)
+    for i in range(8):
+        octet = flat[offsets + i].astype(np.uint64)
+        value = np.where(i < sz, (value << np.uint64(8)) | octet, value)
+    return value
@@ -5,16 +5,119 @@ Data Link Layer (LNK) Heymac protocol command messages
 """
 
 import struct
+import zlib   # crc32(), (de)compressobj()
 
 
 class HeymacCmdError(Exception):
     pass
 
 
+class _CmdSchema(object):
+    """The compiled layout of a Heymac command's fields.
+
+    Built once per command class from the class's declaration:
+    _FIXED are the fixed-size fields, _ARRAYS are the counted arrays
+    (a count octet and that many items) and _TAIL is the field that takes
+    the rest of the command.  The struct.Struct objects are cached here,
+    so no format strings are built while encoding or decoding.
+    """
+    def __init__(self, cmd_cls):
+        self.hdr = bytes((HeymacCmd.PREFIX | cmd_cls.CMD_ID,) +
+                         ((cmd_cls.SUB_ID,) if cmd_cls._HAS_SUB_ID else ()))
+        self.fixed_flds = tuple(fld_nm for fld_nm, _ in cmd_cls._FIXED)
+        self.fixed = struct.Struct(
+            "!" + "".join(fmt for _, fmt in cmd_cls._FIXED))
+        # Each array is (field name, item Struct, True if an item is
+        # a single value instead of a tuple)
+        self.arrays = tuple(
+            (fld_nm, struct.Struct("!" + fmt), len(_item_fmt_values(fmt)) == 1)
+            for fld_nm, fmt in cmd_cls._ARRAYS)
+        self.tail = cmd_cls._TAIL
+
+
+    def get_sz(self, field):
+        """Returns the size of the serialized command with these fields."""
+        sz = len(self.hdr) + self.fixed.size
+        for fld_nm, item, _ in self.arrays:
+            sz += 1 + len(field[fld_nm]) * item.size
+        if self.tail:
+            sz += len(field[self.tail])
+        return sz
+
+
+    def pack_into(self, field, buf, offset):
+        """Serializes the fields into buf starting at offset."""
+        buf[offset:offset + len(self.hdr)] = self.hdr
+        offset += len(self.hdr)
+        self.fixed.pack_into(
+            buf, offset, *[field[fld_nm] for fld_nm in self.fixed_flds])
+        offset += self.fixed.size
+        for fld_nm, item, single in self.arrays:
+            items = field[fld_nm]
+            if len(items) > 255:
+                raise HeymacCmdError("Too many items in %s" % fld_nm)
+            buf[offset] = len(items)
+            offset += 1
+            for value in items:
+                if single:
+                    item.pack_into(buf, offset, value)
+                else:
+                    item.pack_into(buf, offset, *value)
+                offset += item.size
+        if self.tail:
+            value = field[self.tail]
+            buf[offset:offset + len(value)] = value
+
+
+    def unpack(self, cmd_bytes):
+        """Returns the dict of fields parsed from cmd_bytes.
+
+        Raises HeymacCmdError if the bytes do not fit the layout.
+        """
+        offset = len(self.hdr)
+        if len(cmd_bytes) < offset + self.fixed.size:
+            raise HeymacCmdError("Incorrect data size")
+        field = dict(zip(self.fixed_flds,
+                         self.fixed.unpack_from(cmd_bytes, offset)))
+        offset += self.fixed.size
+        for fld_nm, item, single in self.arrays:
+            if offset >= len(cmd_bytes):
+                raise HeymacCmdError("Incorrect data size")
+            end = offset + 1 + cmd_bytes[offset] * item.size
+            if end > len(cmd_bytes):
+                raise HeymacCmdError("Incorrect data size")
+            items = item.iter_unpack(memoryview(cmd_bytes)[offset + 1:end])
+            if single:
+                field[fld_nm] = tuple(value for value, in items)
+            else:
+                field[fld_nm] = tuple(items)
+            offset = end
+        if self.tail:
+            field[self.tail] = cmd_bytes[offset:]
+        elif offset != len(cmd_bytes):
+            raise HeymacCmdError("Incorrect data size")
+        return field
+
+
+def _item_fmt_values(fmt):
+    """Returns the values struct would unpack for one item of the format."""
+    return struct.unpack("!" + fmt, bytes(struct.calcsize("!" + fmt)))
+
+
 class HeymacCmd(object):
     """A Heymac Command message
 
     Offers methods to serialize and parse Heymac Command bytes.
+
+    A subclass declares its CMD_ID (and SUB_ID, if it is a sub-command)
+    and the layout of its fields after those octets::
+
+        _FIXED = ((FLD_NAME, "H"), ...)     # fixed-size fields
+        _ARRAYS = ((FLD_NAME, "H8s"), ...)  # counted arrays of items
+        _TAIL = FLD_NAME                    # bytes to the end (or None)
+
+    The formats are struct formats in Network Order (big-endian).
+    The layout is compiled when the class is defined.
     """
     # Heymac segments (hdr, body, etc) have a small, unique bit pattern
     # at the start of the segment called a prefix.
@@ -26,62 +129,121 @@ class HeymacCmd(object):
     # Field names are used to index into each
     # Heymac commands' self.field dict.
     FLD_CAPS = "FLD_CAPS"       # int (0..65535)
+    FLD_CMDS = "FLD_CMDS"       # bytes (length-prefixed commands)
+    FLD_DGRAM_ID = "FLD_DGRAM_ID"   # int (0..65535)
+    FLD_DGRAM_SZ = "FLD_DGRAM_SZ"   # int (0..65535)
+    FLD_FRAG = "FLD_FRAG"       # bytes
+    FLD_FRAG_OFF = "FLD_FRAG_OFF"   # int (0..65535)
     FLD_MSG = "FLD_MSG"         # bytes
-    FLD_NETS = "FLD_NETS"       # sequence of bytes
+    FLD_NETS = "FLD_NETS"       # sequence of (net_id, root lnk_addr)
     FLD_NGBRS = "FLD_NGBRS"     # sequence of bytes
+    FLD_NGBR_HASHES = "FLD_NGBR_HASHES"     # sequence of int (0..65535)
     FLD_STATUS = "FLD_STATUS"   # int (0..65535)
+    FLD_ZMSG = "FLD_ZMSG"       # bytes (compressed FLD_MSG)
     FLD_NET_ID = "FLD_NET_ID"   # int (0..65535)
     FLD_NET_ADDR = "FLD_NET_ADDR"   # int (0..65535)
 
+    # Command classes by (CMD_ID, SUB_ID).  SUB_ID is None for
+    # commands that do not have sub-commands.
+    _CMD_REGISTRY = {}
 
-    def __init__(self, *args, **kwargs):
-        """Instantiates a subclass of HeymacCmd
+    # The CMD_IDs of commands that have sub-commands
+    _SUB_CMD_IDS = set()
+
+    # A subclass sets this True if it is the base of sub-commands
+    # (so only its subclasses that define SUB_ID are registered)
+    _HAS_SUB_ID = False
+
+    # Field layout declaration (see the class docstring)
+    _FIXED = ()
+    _ARRAYS = ()
+    _TAIL = None
+
+    # The compiled layout (None for classes that are not registered)
+    _SCHEMA = None
 
-        Expects either one positional arg that is the
-        serialized bytes for a HeymacCmd subclass,
-        or expects one positional arg and one or more keyword args.
-        In the latter case, the positional arg is the command ID
-        and the keyword args are the field names and values.
-        (see the code comments for FLD_* (above) to know the data type)
+
+    def __init_subclass__(cls, **kwargs):
+        """Registers each command class and compiles its layout
+        when the class is defined.
+
+        This lets a subclass (even one outside this module)
+        be parsed by HeymacCmd.parse() by simply defining it.
         """
-        if len(args) != 1:
-            raise TypeError("Expecting one positional argument")
-
-        if kwargs:
-            assert type(args[0]) is int, "Expecting Command ID int"
-            # If keyword arguments, expect certain field names
-            for key in kwargs.keys():
-                if key not in self._FLD_LIST:
-                    raise HeymacCmdError("Unknown field: %s" % key)
-            # kwargs become the command's fields
-            self.field = kwargs
-        else:
-            if type(args[0]) is bytes:
-                cmd_bytes = args[0]
-            elif type(args[0]) is int:
-                self.field = {}
+        super().__init_subclass__(**kwargs)
+        cls._FLD_LIST = (tuple(fld_nm for fld_nm, _ in cls._FIXED) +
+                         tuple(fld_nm for fld_nm, _ in cls._ARRAYS) +
+                         ((cls._TAIL,) if cls._TAIL else ()))
+        if cls._HAS_SUB_ID:
+            if "SUB_ID" in cls.__dict__:
+                key = (cls.CMD_ID, cls.SUB_ID)
+                HeymacCmd._SUB_CMD_IDS.add(cls.CMD_ID)
             else:
-                raise TypeError()
+                return
+        elif "CMD_ID" in cls.__dict__:
+            key = (cls.CMD_ID, None)
+        else:
+            return
+        if key in HeymacCmd._CMD_REGISTRY:
+            raise HeymacCmdError("Command ID already registered: %d, %s"
+                                 % key)
+        HeymacCmd._CMD_REGISTRY[key] = cls
+        cls._SCHEMA = _CmdSchema(cls)
 
 
-    @staticmethod
-    def parse(cmd_bytes):
+    def __init__(self, **kwargs):
+        """Instantiates a subclass of HeymacCmd
+
+        The keyword args are the field names and values
+        (see the code comments for FLD_* (above) to know the data type).
+        Every field in the subclass's layout must be given.
+        """
+        for key in kwargs.keys():
+            if key not in self._FLD_LIST:
+                raise HeymacCmdError("Unknown field: %s" % key)
+        for key in self._FLD_LIST:
+            if key not in kwargs:
+                raise HeymacCmdError("Missing field: %s" % key)
+        # kwargs become the command's fields
+        self.field = kwargs
+
+
+    def __bytes__(self,):
+        """Serializes the command into bytes."""
+        b = bytearray(self._SCHEMA.get_sz(self.field))
+        self._SCHEMA.pack_into(self.field, b, 0)
+        return bytes(b)
+
+
+    @classmethod
+    def parse(cls, cmd_bytes):
         """Parses the serialized cmd_bytes into a HeymacCommand subclass.
 
-        Uses the subclass 's parse() method to perform specific parsing.
+        Called on HeymacCmd (or a base of sub-commands), looks up the
+        subclass by its (CMD_ID, SUB_ID) and uses the subclass's parse().
+        Called on a base of sub-commands, the subclass must be one of its.
+        Called on a subclass, parses cmd_bytes by the subclass's layout.
         """
         assert type(cmd_bytes) is bytes
         if len(cmd_bytes) < 1:
             raise HeymacCmdError("Insufficient data")
-        cmd = None
-        for cmd_cls in HeymacCmd.__subclasses__():
-            if (HeymacCmd.PREFIX | cmd_cls.CMD_ID) == cmd_bytes[0]:
-                cmd = cmd_cls.parse(cmd_bytes)
-                break
-        if not cmd:
-            raise HeymacCmdError("Unknown CMD_ID: %d"
-                                 % (cmd_bytes[0] & HeymacCmd.CMD_MASK))
-        return cmd
+        if cls._SCHEMA is not None:
+            return cls._parse_fields(cmd_bytes)
+        cmd_id = cmd_bytes[0] & HeymacCmd.CMD_MASK
+        cmd_cls = None
+        if (cmd_bytes[0] & HeymacCmd.PREFIX_MASK) == HeymacCmd.PREFIX:
+            cmd_cls = HeymacCmd._CMD_REGISTRY.get((cmd_id, None))
+            if cmd_cls is None and cmd_id in HeymacCmd._SUB_CMD_IDS:
+                if len(cmd_bytes) < 2:
+                    raise HeymacCmdError("Insufficient data")
+                cmd_cls = HeymacCmd._CMD_REGISTRY.get((cmd_id, cmd_bytes[1]))
+                if cmd_cls is None:
+                    raise HeymacCmdError("Unknown SUB_ID: %d" % cmd_bytes[1])
+        if cmd_cls is None:
+            raise HeymacCmdError("Unknown CMD_ID: %d" % cmd_id)
+        if not issubclass(cmd_cls, cls):
+            raise HeymacCmdError("Incorrect CMD_ID: %d" % cmd_id)
+        return cmd_cls.parse(cmd_bytes)
 
 
     def get_field(self, fld_name):
@@ -89,80 +251,295 @@ class HeymacCmd(object):
         return self.field[fld_name]
 
 
+# Private
+
+
+    @classmethod
+    def _parse_fields(cls, cmd_bytes):
+        """Parses cmd_bytes by this subclass's compiled layout."""
+        hdr = cls._SCHEMA.hdr
+        if cmd_bytes[0] != hdr[0]:
+            raise HeymacCmdError("Incorrect CMD_ID: %d"
+                                 % (cmd_bytes[0] & HeymacCmd.CMD_MASK))
+        if len(hdr) > 1:
+            if len(cmd_bytes) < 2:
+                raise HeymacCmdError("Insufficient data")
+            if cmd_bytes[1] != hdr[1]:
+                raise HeymacCmdError("Unknown SUB_ID: %d" % cmd_bytes[1])
+        return cls(**cls._SCHEMA.unpack(cmd_bytes))
+
+
 class HeymacCmdTxt(HeymacCmd):
     """Heymac Text message: {3, data }"""
     CMD_ID = 3
-    _FLD_LIST = (HeymacCmd.FLD_MSG,)
+    _TAIL = HeymacCmd.FLD_MSG
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(self.CMD_ID, **kwargs)
 
-    def __bytes__(self,):
-        b = bytearray()
-        b.append(HeymacCmd.PREFIX | HeymacCmdTxt.CMD_ID)
-        b.extend(self.field[HeymacCmd.FLD_MSG])
-        return bytes(b)
+class HeymacCmdZtxt(HeymacCmd):
+    """Heymac Compressed Text message: {9, zdata }
+
+    The text is compressed by raw DEFLATE (zlib with no header)
+    primed with a preset dictionary of common ham radio text.
+    get_field(FLD_MSG) gives the text, as for a HeymacCmdTxt.
+    Only send this to nodes whose beacon has the LNK_CAP_ZTXT capability.
+    """
+    CMD_ID = 9
+    _TAIL = HeymacCmd.FLD_ZMSG
+
+    # The preset dictionary.  It is part of the protocol:
+    # changing it breaks decompression between nodes.
+    # Most common strings go last (nearest the text).
+    _ZDICT = (
+        b"QTH QRZ QSL QSO QRM QRN QSB QRT QRV QSY RST 599 5NN TNX FB OM "
+        b"YL WX GRID ANT PWR BATT TEMP RSSI SNR NET JOIN LEAVE STATUS OK "
+        b"heymac HeyMac 73 88 DE K KN SK BK AR CQ CQ CQ DE ")
+
+    # The largest text decompressed (a bound on memory for bad data)
+    MSG_SZ_MAX = 4096
+
 
     @staticmethod
-    def parse(cmd_bytes):
-        assert cmd_bytes[0] == HeymacCmd.PREFIX | HeymacCmdTxt.CMD_ID
-        field = {}
-        field[HeymacCmd.FLD_MSG] = cmd_bytes[1:]
-        return HeymacCmdTxt(HeymacCmdTxt.CMD_ID, **field)
+    def from_msg(msg):
+        """Returns a command with the text msg: a HeymacCmdZtxt
+        if that is smaller, else a HeymacCmdTxt.
+        """
+        comp = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                zdict=HeymacCmdZtxt._ZDICT)
+        zmsg = comp.compress(msg) + comp.flush()
+        if len(zmsg) < len(msg):
+            return HeymacCmdZtxt(FLD_ZMSG=zmsg)
+        return HeymacCmdTxt(FLD_MSG=msg)
+
+
+    @classmethod
+    def parse(cls, cmd_bytes):
+        """Parses the bytes into a compressed text object.
+
+        Raises HeymacCmdError if the text does not decompress.
+        """
+        cmd = super().parse(cmd_bytes)
+        cmd.get_field(HeymacCmd.FLD_MSG)
+        return cmd
+
+
+    def get_field(self, fld_name):
+        """Returns the value of the field.
+        FLD_MSG is the decompressed text (made on first access).
+        """
+        if fld_name == HeymacCmd.FLD_MSG \
+                and HeymacCmd.FLD_MSG not in self.field:
+            self.field[HeymacCmd.FLD_MSG] = self._decompress()
+        return self.field[fld_name]
+
+
+# Private
+
+
+    def _decompress(self,):
+        """Returns the text decompressed from FLD_ZMSG."""
+        decomp = zlib.decompressobj(-zlib.MAX_WBITS,
+                                    zdict=HeymacCmdZtxt._ZDICT)
+        try:
+            msg = decomp.decompress(self.field[HeymacCmd.FLD_ZMSG],
+                                    HeymacCmdZtxt.MSG_SZ_MAX)
+        except zlib.error as e:
+            raise HeymacCmdError("Bad compressed text: %s" % e)
+        if not decomp.eof or decomp.unconsumed_tail or decomp.unused_data:
+            raise HeymacCmdError("Bad compressed text")
+        return msg
 
 
 class HeymacCmdCsmaBcn(HeymacCmd):
     """Heymac CSMA Beacon: { 4, caps, status, nets[], ngbrs[] }"""
     # NOTE: form not finalized
     CMD_ID = 4
-    _FLD_LIST = (
-        HeymacCmd.FLD_CAPS,
-        HeymacCmd.FLD_STATUS,
-        HeymacCmd.FLD_NETS,
-        HeymacCmd.FLD_NGBRS)
+    _FIXED = (
+        (HeymacCmd.FLD_CAPS, "H"),
+        (HeymacCmd.FLD_STATUS, "H"))
+    _ARRAYS = (
+        (HeymacCmd.FLD_NETS, "H8s"),
+        (HeymacCmd.FLD_NGBRS, "8s"))
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(self.CMD_ID, **kwargs)
 
-    def __bytes__(self,):
-        """Serializes the beacon into bytes to send over the air."""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # The set of neighbors is made once for fast has_ngbr() tests
+        self._ngbrs = frozenset(self.field[HeymacCmd.FLD_NGBRS])
+
+
+    def get_ngbrs(self,):
+        """Returns the frozenset of the beacon's neighbors' link addresses."""
+        return self._ngbrs
+
+
+    def has_ngbr(self, lnk_addr):
+        """Returns True if the given link address is in the beacon's
+        neighbors field.
+        """
+        return lnk_addr in self._ngbrs
+
+
+class HeymacCmdCsmaBcnHashed(HeymacCmd):
+    """Heymac CSMA Beacon with hashed neighbors:
+    { 6, caps, status, nets[], ngbr_hashes[] }
+
+    The compact form of HeymacCmdCsmaBcn for dense neighborhoods.
+    Each neighbor is a 16-bit hash of its link address (see ngbr_hash())
+    instead of the 8-byte address, so more neighbors fit in a frame.
+    A hash can collide, so has_ngbr() may give a false positive
+    (about n in 65536 for n neighbors).
+    """
+    CMD_ID = 6
+    _FIXED = (
+        (HeymacCmd.FLD_CAPS, "H"),
+        (HeymacCmd.FLD_STATUS, "H"))
+    _ARRAYS = (
+        (HeymacCmd.FLD_NETS, "H8s"),
+        (HeymacCmd.FLD_NGBR_HASHES, "H"))
+
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # The set of hashes is made once for fast has_ngbr() tests
+        self._ngbr_hashes = frozenset(self.field[HeymacCmd.FLD_NGBR_HASHES])
+
+
+    @staticmethod
+    def from_ngbrs(caps, status, nets, ngbrs):
+        """Returns a hashed beacon of the given neighbors' link addresses."""
+        return HeymacCmdCsmaBcnHashed(
+            FLD_CAPS=caps,
+            FLD_STATUS=status,
+            FLD_NETS=nets,
+            FLD_NGBR_HASHES=sorted(
+                set(map(HeymacCmdCsmaBcnHashed.ngbr_hash, ngbrs))))
+
+
+    def get_ngbr_hashes(self,):
+        """Returns the frozenset of the beacon's neighbors' hashes."""
+        return self._ngbr_hashes
+
+
+    @staticmethod
+    def ngbr_hash(lnk_addr):
+        """Returns the 16-bit hash of a neighbor's link address."""
+        return zlib.crc32(lnk_addr) & 0xFFFF
+
+
+    def has_ngbr(self, lnk_addr):
+        """Returns True if the given link address (probably) is
+        one of the beacon's neighbors.
+        """
+        return HeymacCmdCsmaBcnHashed.ngbr_hash(lnk_addr) in self._ngbr_hashes
+
+
+class HeymacCmdAggr(HeymacCmd):
+    """Heymac Aggregate: {7, (len, cmd)[] }
+
+    Carries several commands in one frame's payload so they share
+    the frame's (and the PHY's) overhead.  Each command is prefixed
+    by its length in one octet.  An aggregate may not hold an aggregate.
+    """
+    CMD_ID = 7
+    _TAIL = HeymacCmd.FLD_CMDS
+
+    # The largest command that fits in an aggregate
+    CMD_SZ_MAX = 255
+
+
+    @staticmethod
+    def from_cmds(cmds):
+        """Returns an aggregate of the given commands
+        (HeymacCmd objects or serialized commands).
+
+        Raises HeymacCmdError if there are no commands
+        or if a command is empty, too large or an aggregate.
+        """
         b = bytearray()
-        b.append(HeymacCmd.PREFIX | HeymacCmdCsmaBcn.CMD_ID)
-        b.extend(struct.pack("!H", self.field[HeymacCmd.FLD_CAPS]))
-        b.extend(struct.pack("!H", self.field[HeymacCmd.FLD_STATUS]))
-        # Nets
-        b.append(len(self.field[HeymacCmd.FLD_NETS]))
-        for net in self.field[HeymacCmd.FLD_NETS]:
-            b.extend(struct.pack("!H", net[0]))
-            b.extend(struct.pack("8s", net[1]))
-        # Ngbrs
-        b.append(len(self.field[HeymacCmd.FLD_NGBRS]))
-        for lnk_addr in self.field[HeymacCmd.FLD_NGBRS]:
-            b.extend(lnk_addr)
-        return bytes(b)
+        for cmd in cmds:
+            cmd_bytes = bytes(cmd)
+            if not cmd_bytes:
+                raise HeymacCmdError("Command is empty")
+            if len(cmd_bytes) > HeymacCmdAggr.CMD_SZ_MAX:
+                raise HeymacCmdError("Command is too large to aggregate")
+            if cmd_bytes[0] == HeymacCmdAggr._SCHEMA.hdr[0]:
+                raise HeymacCmdError("Aggregates cannot be nested")
+            b.append(len(cmd_bytes))
+            b.extend(cmd_bytes)
+        if not b:
+            raise HeymacCmdError("Aggregate has no commands")
+        return HeymacCmdAggr(FLD_CMDS=bytes(b))
+
+
+    @classmethod
+    def parse(cls, cmd_bytes):
+        """Parses the bytes into an aggregate object.
+
+        Raises HeymacCmdError if the lengths of the commands
+        do not fit the data.
+        """
+        cmd = super().parse(cmd_bytes)
+        cmd.get_cmds_bytes()
+        return cmd
+
+
+    def get_cmds_bytes(self,):
+        """Returns a tuple of the serialized commands in the aggregate."""
+        cmds = self.field[HeymacCmd.FLD_CMDS]
+        cmds_bytes = []
+        offset = 0
+        while offset < len(cmds):
+            end = offset + 1 + cmds[offset]
+            if cmds[offset] == 0 or end > len(cmds):
+                raise HeymacCmdError("Incorrect data size")
+            cmds_bytes.append(cmds[offset + 1:end])
+            offset = end
+        return tuple(cmds_bytes)
+
+
+    def get_cmds(self,):
+        """Returns a tuple of the commands in the aggregate.
+        A command that cannot be parsed is None.
+        """
+        cmds = []
+        for cmd_bytes in self.get_cmds_bytes():
+            try:
+                cmd = HeymacCmd.parse(cmd_bytes)
+            except HeymacCmdError:
+                cmd = None
+            if type(cmd) is HeymacCmdAggr:
+                cmd = None
+            cmds.append(cmd)
+        return tuple(cmds)
+
+
+class HeymacCmdFrag(HeymacCmd):
+    """Heymac Fragment: {8, dgram_id, dgram_sz, frag_off, frag }
+
+    One piece of a datagram that is too large for a frame.
+    The fragment's offset in the datagram lets the receiver
+    copy it into place no matter the order of arrival.
+    """
+    CMD_ID = 8
+    _FIXED = (
+        (HeymacCmd.FLD_DGRAM_ID, "H"),
+        (HeymacCmd.FLD_DGRAM_SZ, "H"),
+        (HeymacCmd.FLD_FRAG_OFF, "H"))
+    _TAIL = HeymacCmd.FLD_FRAG
+
 
     @staticmethod
-    def parse(cmd_bytes):
-        """Parses the bytes into a beacon object."""
-        SIZEOF_NET = 2 + 8
-        assert cmd_bytes[0] == HeymacCmd.PREFIX | HeymacCmdCsmaBcn.CMD_ID
-        field = {}
-        caps, status = struct.unpack("!HH", cmd_bytes[1:5])
-        field[HeymacCmd.FLD_CAPS] = caps
-        field[HeymacCmd.FLD_STATUS] = status
-        # Nets
-        nets_cnt = cmd_bytes[5]
-        fmt = "!" + "H8s" * nets_cnt
-        nets_sz = struct.calcsize(fmt)
-        nets = struct.unpack(fmt, cmd_bytes[6:6 + nets_sz])
-        field[HeymacCmd.FLD_NETS] = nets
-        offset = 6 + nets_sz
-        # Ngbrs
-        ngbrs_cnt = cmd_bytes[offset]
-        fmt = "!" + "8s" * ngbrs_cnt
-        ngbrs = struct.unpack(fmt, cmd_bytes[offset + 1:])
-        field[HeymacCmd.FLD_NGBRS] = ngbrs
-        return HeymacCmdCsmaBcn(HeymacCmdCsmaBcn.CMD_ID, **field)
+    def from_dgram(dgram, dgram_id, frag_sz):
+        """Returns a list of the Fragments of the datagram
+        with up to frag_sz octets of the datagram in each.
+        """
+        if len(dgram) > 0xFFFF:
+            raise HeymacCmdError("Datagram is too large")
+        return [HeymacCmdFrag(FLD_DGRAM_ID=dgram_id,
+                              FLD_DGRAM_SZ=len(dgram),
+                              FLD_FRAG_OFF=frag_off,
+                              FLD_FRAG=dgram[frag_off:frag_off + frag_sz])
+                for frag_off in range(0, len(dgram), frag_sz)]
 
 
 class HeymacCmdJoin(HeymacCmd):
@@ -172,86 +549,32 @@ class HeymacCmdJoin(HeymacCmd):
     This class serves as a base class for a range of join sub-commands.
     """
     CMD_ID = 5
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(self.CMD_ID, **kwargs)
-
-    def __bytes__(self,):
-        """Serializes the join-command into bytes."""
-        b = bytearray()
-        b.append(HeymacCmd.PREFIX | self.CMD_ID)
-        b.append(self.SUB_ID)
-        if HeymacCmd.FLD_NET_ID in self.field:
-            b.extend(struct.pack("!H", self.field[HeymacCmd.FLD_NET_ID]))
-        if HeymacCmd.FLD_NET_ADDR in self.field:
-            b.extend(struct.pack("!H", self.field[HeymacCmd.FLD_NET_ADDR]))
-        return bytes(b)
-
-    @staticmethod
-    def parse(cmd_bytes):
-        """Parses the bytes into a join-command object."""
-        assert type(cmd_bytes) is bytes
-        if len(cmd_bytes) < 2:
-            raise HeymacCmdError("Insufficient data")
-        if cmd_bytes[0] != (HeymacCmd.PREFIX | HeymacCmdJoin.CMD_ID):
-            raise HeymacCmdError("Incorrect CMD_ID: %d"
-                                 % (cmd_bytes[0] & HeymacCmd.CMD_MASK))
-        cmd = None
-        for joincmd_cls in HeymacCmdJoin.__subclasses__():
-            if joincmd_cls.SUB_ID == cmd_bytes[1]:
-                try:
-                    if joincmd_cls.SUB_ID in (HeymacCmdJoinRqst.SUB_ID,):
-                        field = {}
-                        net_id = struct.unpack("!H", cmd_bytes[2:])[0]
-                        field[HeymacCmd.FLD_NET_ID] = net_id
-                        cmd = joincmd_cls(HeymacCmdTxt.CMD_ID, **field)
-                        break
-                    elif joincmd_cls.SUB_ID in (HeymacCmdJoinAcpt.SUB_ID,
-                                                HeymacCmdJoinCnfm.SUB_ID):
-                        field = {}
-                        net_id, net_addr = struct.unpack("!HH", cmd_bytes[2:])
-                        field[HeymacCmd.FLD_NET_ID] = net_id
-                        field[HeymacCmd.FLD_NET_ADDR] = net_addr
-                        cmd = joincmd_cls(HeymacCmdTxt.CMD_ID, **field)
-                        break
-                    else:
-                        assert len(cmd_bytes) == 2
-                        cmd = joincmd_cls()
-                        break
-                except struct.error:
-                    raise HeymacCmdError("Incorrect data size")
-                except AssertionError:
-                    raise HeymacCmdError("Incorrect data size")
-        if not cmd:
-            raise HeymacCmdError("Unknown SUB_ID: %d" % cmd_bytes[1])
-        return cmd
+    _HAS_SUB_ID = True
 
 
 class HeymacCmdJoinRqst(HeymacCmdJoin):
     """Heymac Join-Request: {5, 1, net_id}"""
     SUB_ID = 1
-    _FLD_LIST = (HeymacCmd.FLD_NET_ID,)
+    _FIXED = ((HeymacCmd.FLD_NET_ID, "H"),)
 
 
 class HeymacCmdJoinAcpt(HeymacCmdJoin):
     """Heymac Join-Accept: {5, 2, net_id, net_addr}"""
     SUB_ID = 2
-    _FLD_LIST = (HeymacCmd.FLD_NET_ID, HeymacCmd.FLD_NET_ADDR)
+    _FIXED = ((HeymacCmd.FLD_NET_ID, "H"), (HeymacCmd.FLD_NET_ADDR, "H"))
 
 
 class HeymacCmdJoinCnfm(HeymacCmdJoin):
     """Heymac Join-Confirm: {5, 3, net_id, net_addr}"""
     SUB_ID = 3
-    _FLD_LIST = (HeymacCmd.FLD_NET_ID, HeymacCmd.FLD_NET_ADDR)
+    _FIXED = ((HeymacCmd.FLD_NET_ID, "H"), (HeymacCmd.FLD_NET_ADDR, "H"))
 
 
 class HeymacCmdJoinRjct(HeymacCmdJoin):
     """Heymac Join-Reject: {5, 4}"""
     SUB_ID = 4
-    _FLD_LIST = ()
 
 
 class HeymacCmdJoinLeav(HeymacCmdJoin):
     """Heymac Join-Leave: {5, 5}"""
     SUB_ID = 5
-    _FLD_LIST = ()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Measures the per-frame cost of each HeymacFrame.parse() mode
+and of MIC verification on the receive path.
+
+Run from the repository root:  python3 tests/bench_lnk_frame.py
+"""
+
+
+import hashlib
+import hmac
+import timeit
+
+from lnk_heymac import HeymacFrame
+
+
+# Frames typical of the receive path:
+# a CSMA beacon with a long source address and a short multihop data frame
+FRAMES = (
+    ("beacon", b"\xE4\x44\xc1\xc2\xc3\xc4\xc5\xc6\xc7\xc8"
+               b"\x84\x00\x02\x00\x00\x00\x01\xfd2345678"),
+    ("mhop data", b"\xE4\x36\x80\xa5\xd1\xd2\xc1\xc2" +
+                  bytes(range(200)) + b"\x03\xe1\xe2"),
+)
+
+MODES = (
+    ("strict", {}),
+    ("trusted", {"trusted": True}),
+    ("lazy", {"lazy": True}),
+)
+
+CNT = 20000
+
+MIC_KEY = b"0123456789abcdef"
+
+
+def mk_mic_frame():
+    """Returns the bytes of a data frame with an 8-byte MIC."""
+    f = HeymacFrame(
+        HeymacFrame.PID_IDENT_HEYMAC | HeymacFrame.PID_TYPE_CSMA,
+        HeymacFrame.FCTL_I | HeymacFrame.FCTL_S)
+    f.set_field(HeymacFrame.FLD_SADDR, b"\xc1\xc2")
+    f.set_field(HeymacFrame.FLD_PAYLD, bytes(range(100)))
+    f.add_mic(MIC_KEY)
+    return bytes(f)
+
+
+def bench_mic():
+    frame_bytes = mk_mic_frame()
+    frames = [HeymacFrame.parse(frame_bytes, lazy=True) for _ in range(CNT)]
+    print("mic ({} bytes)".format(len(frame_bytes)))
+
+    def parse_only():
+        HeymacFrame.parse(frame_bytes, lazy=True).get_sender()
+
+    def parse_and_verify():
+        f = HeymacFrame.parse(frame_bytes, lazy=True)
+        assert f.verify_mic(MIC_KEY)
+
+    def parse_and_verify_rekeyed():
+        # What verification costs if the key is hashed for every frame
+        f = HeymacFrame.parse(frame_bytes, lazy=True)
+        mic = hmac.new(MIC_KEY, frame_bytes[:-8], hashlib.sha256).digest()
+        assert hmac.compare_digest(mic[:8], f.get_field(HeymacFrame.FLD_MIC))
+
+    for nm, fn in (("parse", parse_only),
+                   ("verify", parse_and_verify),
+                   ("rekeyed", parse_and_verify_rekeyed)):
+        t = min(timeit.repeat(fn, number=CNT, repeat=3))
+        print("    {:8s} {:6.2f} us/frame".format(nm, 1e6 * t / CNT))
+
+    t = min(timeit.repeat(
+        lambda: HeymacFrame.verify_mics(frames, lambda f: MIC_KEY),
+        number=1, repeat=3))
+    print("    {:8s} {:6.2f} us/frame".format("batch", 1e6 * t / CNT))
+
+
+def main():
+    for frame_nm, frame_bytes in FRAMES:
+        print("{} ({} bytes)".format(frame_nm, len(frame_bytes)))
+        for mode_nm, kwargs in MODES:
+            def parse_and_use():
+                f = HeymacFrame.parse(frame_bytes, **kwargs)
+                f.get_sender()
+                f.get_field(HeymacFrame.FLD_PAYLD)
+            t = min(timeit.repeat(parse_and_use, number=CNT, repeat=3))
+            print("    {:8s} {:6.2f} us/frame".format(mode_nm, 1e6 * t / CNT))
+    bench_mic()
+
+
+if __name__ == '__main__':
+    main()
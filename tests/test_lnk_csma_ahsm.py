@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+
+
+import collections
+import unittest
+
+from lnk_heymac import (
+    HeymacFrame, HeymacCmdFrag, HeymacCmdTxt, LnkHeymacCsmaAhsm)
+from lnk_heymac.lnk_heymac_cmd import (
+    HeymacCmd, HeymacCmdAggr, HeymacCmdCsmaBcn, HeymacCmdCsmaBcnHashed,
+    HeymacCmdError, HeymacCmdZtxt)
+
+
+class FakePhy(object):
+    """Stands in for the PHY state machine; keeps the frames sent."""
+    TM_NOW = 0
+
+    def __init__(self,):
+        self.tx = []
+
+    def set_dflt_stngs(self, stngs):
+        pass
+
+    def set_dflt_rx_clbk(self, rx_clbk):
+        pass
+
+    def post_tx_action(self, tm, stngs, frame_bytes):
+        self.tx.append(frame_bytes)
+
+
+def mk_rxd_frame(saddr, payld, taddr=None, rx_meta=(1.0, -60, 9),
+                 hops=1):
+    """Returns a frame from saddr with the payld, as received from the PHY.
+    The frame is multihop, relayed by taddr with hops remaining,
+    if taddr is given.
+    """
+    fctl = HeymacFrame.FCTL_L | HeymacFrame.FCTL_S
+    if taddr:
+        fctl |= HeymacFrame.FCTL_M
+    f = HeymacFrame(
+            HeymacFrame.PID_IDENT_HEYMAC | HeymacFrame.PID_TYPE_CSMA, fctl)
+    f.set_field(HeymacFrame.FLD_SADDR, saddr)
+    f.set_field(HeymacFrame.FLD_PAYLD, bytes(payld))
+    if taddr:
+        f.set_field(HeymacFrame.FLD_HOPS, hops)
+        f.set_field(HeymacFrame.FLD_TADDR, taddr)
+    f = HeymacFrame.parse(bytes(f), lazy=True)
+    f.rx_meta = rx_meta
+    return f
+
+
+def mk_addr(i):
+    """Returns the i-th neighbor's link address."""
+    return b"\xfd\x01" + i.to_bytes(6, "big")
+
+
+class TestLnkCsmaAhsm(unittest.TestCase):
+    """Tests the link layer's handling of frames to and from the PHY."""
+
+    def _mk_lnk(self, ngbrs_cnt=0):
+        lnk = LnkHeymacCsmaAhsm(FakePhy())
+        for i in range(ngbrs_cnt):
+            lnk._on_rxd_from_phy(
+                mk_rxd_frame(mk_addr(i), HeymacCmdTxt(FLD_MSG=b"hi")))
+        return lnk
+
+
+    def _start_lnk(self, lnk):
+        """Starts the state machine (without the framework)
+        and runs it until its queue is empty.
+        """
+        lnk.mq = collections.deque()
+        lnk.init()
+        self._run_lnk(lnk)
+
+
+    def _run_lnk(self, lnk):
+        while lnk.has_msgs():
+            lnk.dispatch(lnk.pop_msg())
+
+
+    def _get_tx_cmds(self, lnk):
+        """Returns the commands sent, as (daddr, cmd bytes) per frame,
+        and clears the frames sent.
+        """
+        cmds = []
+        for b in lnk.phy_ahsm.tx:
+            f = HeymacFrame.parse(b)
+            cmds.append((f.get_field(HeymacFrame.FLD_DADDR),
+                         f.get_field(HeymacFrame.FLD_PAYLD)))
+        lnk.phy_ahsm.tx.clear()
+        return cmds
+
+
+    def _get_dgrams(self, lnk):
+        """Returns the list that gets each datagram the lnk receives,
+        as (SrcAddr, dgram).
+        """
+        dgrams = []
+        lnk.set_dgram_clbk(lambda frame, dgram: dgrams.append(
+            (frame.get_field(HeymacFrame.FLD_SADDR), dgram)))
+        return dgrams
+
+
+    def _parse_bcn(self, b):
+        self.assertLessEqual(len(b), HeymacFrame.FRAME_SZ_MAX)
+        return HeymacCmd.parse(
+            HeymacFrame.parse(b).get_field(HeymacFrame.FLD_PAYLD))
+
+
+    def test_bcn_form(self,):
+        # Neighbors are listed by address while the beacon fits a frame
+        full_max = LnkHeymacCsmaAhsm._get_bcn_ngbrs_max(0, 8)
+        self.assertEqual(full_max, 29)
+        for ngbrs_cnt, bcn_cls in ((0, HeymacCmdCsmaBcn),
+                                   (full_max, HeymacCmdCsmaBcn),
+                                   (full_max + 1, HeymacCmdCsmaBcnHashed)):
+            bcn = self._parse_bcn(self._mk_lnk(ngbrs_cnt)._mk_bcn())
+            self.assertIs(type(bcn), bcn_cls)
+        # The largest full beacon fills the frame to within an address
+        b = self._mk_lnk(full_max)._mk_bcn()
+        self.assertGreater(len(b) + 8, HeymacFrame.FRAME_SZ_MAX)
+
+
+    def test_bcn_cache(self,):
+        lnk = self._mk_lnk(2)
+        mk_bcn = lnk._mk_bcn
+        built = []
+        lnk._mk_bcn = lambda: built.append(None) or mk_bcn()
+        tx = lnk.phy_ahsm.tx
+        # An unchanged neighbor table reuses the beacon's bytes
+        lnk._post_bcn()
+        lnk._on_rxd_from_phy(mk_rxd_frame(mk_addr(0), HeymacCmdTxt(
+            FLD_MSG=b"hi"), rx_meta=(2.0, -60, 9)))
+        lnk._post_bcn()
+        self.assertEqual(len(built), 1)
+        self.assertIs(tx[1], tx[0])
+        # A neighbor's new caps, a new neighbor and an expired neighbor
+        # each rebuild the beacon
+        bcn = HeymacCmdCsmaBcn(
+            FLD_CAPS=LnkHeymacCsmaAhsm.LNK_CAP_ZTXT, FLD_STATUS=0,
+            FLD_NETS=(), FLD_NGBRS=())
+        for rx_frame in (mk_rxd_frame(mk_addr(0), bcn, rx_meta=(3.0, -60, 9)),
+                         mk_rxd_frame(mk_addr(2), bcn, rx_meta=(4.0, -60, 9)),
+                         None):
+            gen = lnk._lnk_data.get_generation()
+            built_cnt = len(built)
+            if rx_frame:
+                lnk._on_rxd_from_phy(rx_frame)
+            else:
+                lnk._lnk_data.update(
+                    1.0 + LnkHeymacCsmaAhsm._NGBR_EXPIRATION_PRD + 0.5)
+            self.assertNotEqual(lnk._lnk_data.get_generation(), gen)
+            lnk._post_bcn()
+            self.assertEqual(len(built), built_cnt + 1)
+            self.assertEqual(bytes(tx[-1]), mk_bcn())
+        # The expired neighbor (mk_addr(1)) is no longer listed
+        ngbrs = self._parse_bcn(tx[-1]).get_ngbrs()
+        self.assertEqual(ngbrs, {mk_addr(0), mk_addr(2)})
+
+
+    def test_bcn_hashed_max(self,):
+        # A hashed beacon lists as many neighbors as fit a frame
+        hashed_max = LnkHeymacCsmaAhsm._get_bcn_ngbrs_max(0, 2)
+        self.assertEqual(hashed_max, 119)
+        for ngbrs_cnt in (hashed_max, hashed_max + 1, 300):
+            bcn = self._parse_bcn(self._mk_lnk(ngbrs_cnt)._mk_bcn())
+            self.assertIs(type(bcn), HeymacCmdCsmaBcnHashed)
+            self.assertLessEqual(len(bcn.get_ngbr_hashes()), hashed_max)
+        # and those with the best link quality are listed first
+        lnk = self._mk_lnk(hashed_max + 10)
+        good = [mk_addr(i) for i in range(5)]
+        for saddr in good:
+            lnk._on_rxd_from_phy(mk_rxd_frame(saddr, HeymacCmdCsmaBcn(
+                FLD_CAPS=0, FLD_STATUS=0, FLD_NETS=(), FLD_NGBRS=())))
+        bcn = self._parse_bcn(lnk._mk_bcn())
+        for saddr in good:
+            self.assertTrue(bcn.has_ngbr(saddr))
+        self.assertFalse(bcn.has_ngbr(mk_addr(5)))
+
+
+    def test_post_cmd(self,):
+        lnk = self._mk_lnk()
+        self._start_lnk(lnk)
+        daddr = mk_addr(7)
+        small = [bytes(HeymacCmdTxt(FLD_MSG=b"%d" % i)) for i in range(3)]
+        large = bytes(HeymacCmdTxt(FLD_MSG=b"x" * 229))
+        for cmd_bytes in (small[0], small[1], large, small[2]):
+            lnk.post_cmd(HeymacCmd.parse(cmd_bytes), daddr)
+        lnk.post_cmd(HeymacCmd.parse(small[0]))
+        self._run_lnk(lnk)
+        # Commands are sent in the order they were queued:
+        # aggregated while they fit and a large command alone
+        self.assertEqual(self._get_tx_cmds(lnk), [
+            (daddr, bytes(HeymacCmdAggr.from_cmds(small[:2]))),
+            (daddr, large),
+            (daddr, small[2]),
+            (None, small[0])])
+        self.assertEqual(lnk._cmd_txq, {})
+        # The largest command that fits a frame is sent
+        lnk.post_cmd(HeymacCmdTxt(FLD_MSG=b"x" * 245))
+        self._run_lnk(lnk)
+        self.assertEqual(len(lnk.phy_ahsm.tx[0]), HeymacFrame.FRAME_SZ_MAX)
+        lnk.phy_ahsm.tx.clear()
+        # A command too large for a frame is refused
+        # and the queue keeps working
+        self.assertRaises(HeymacCmdError, lnk.post_txt, b"x" * 240, daddr)
+        self.assertRaises(HeymacCmdError, lnk.post_cmd,
+                          HeymacCmdTxt(FLD_MSG=b"x" * 300))
+        self.assertEqual(lnk._cmd_txq, {})
+        lnk.post_cmd(HeymacCmd.parse(small[0]), daddr)
+        self._run_lnk(lnk)
+        self.assertEqual(self._get_tx_cmds(lnk), [(daddr, small[0])])
+
+
+    def test_post_cmd_initializing(self,):
+        lnk = self._mk_lnk()
+        lnk.mq = collections.deque()
+        lnk.init()
+        # The command's flush event arrives before the link is up
+        lnk.post_cmd(HeymacCmdTxt(FLD_MSG=b"hi"))
+        lnk.dispatch(lnk.mq.popleft())
+        self.assertEqual(lnk._cmd_txq, {None: [b"\x83hi"]})
+        self._run_lnk(lnk)
+        self.assertEqual(self._get_tx_cmds(lnk), [(None, b"\x83hi")])
+
+
+    def test_post_txt(self,):
+        lnk = self._mk_lnk(1)
+        self._start_lnk(lnk)
+        msg = b"CQ CQ CQ DE heymac heymac 73 " * 2
+        lnk.post_txt(msg, mk_addr(0))
+        self._run_lnk(lnk)
+        # Text is compressed only for a neighbor with the ZTXT capability
+        cmd = HeymacCmd.parse(self._get_tx_cmds(lnk)[0][1])
+        self.assertIs(type(cmd), HeymacCmdTxt)
+        lnk._on_rxd_from_phy(mk_rxd_frame(mk_addr(0), HeymacCmdCsmaBcn(
+            FLD_CAPS=LnkHeymacCsmaAhsm.LNK_CAP_ZTXT, FLD_STATUS=0,
+            FLD_NETS=(), FLD_NGBRS=())))
+        lnk.post_txt(msg, mk_addr(0))
+        lnk.post_txt(msg)
+        self._run_lnk(lnk)
+        cmds = [HeymacCmd.parse(payld)
+                for _, payld in self._get_tx_cmds(lnk)]
+        self.assertEqual([type(cmd) for cmd in cmds],
+                         [HeymacCmdZtxt, HeymacCmdZtxt])
+        self.assertEqual(cmds[0].get_field(HeymacCmd.FLD_MSG), msg)
+
+
+    def test_post_dgram(self,):
+        lnk = self._mk_lnk()
+        dgram = bytes(range(256)) * 2
+        lnk.post_dgram(dgram, mk_addr(7))
+        self.assertEqual(len(lnk.phy_ahsm.tx), 3)
+        rx_lnk = self._mk_lnk()
+        dgrams = self._get_dgrams(rx_lnk)
+        for b in lnk.phy_ahsm.tx:
+            f = HeymacFrame.parse(b, lazy=True)
+            f.rx_meta = (1.0, -60, 9)
+            rx_lnk._on_rxd_from_phy(f)
+        self.assertEqual(dgrams, [(lnk._lnk_addr, dgram)])
+        self.assertRaises(HeymacCmdError, lnk.post_dgram,
+                          bytes(LnkHeymacCsmaAhsm._DGRAM_SZ_MAX + 1))
+
+
+    def test_reassemble_mhop(self,):
+        src_a = b"\xfd\x0a" + b"\x00" * 6
+        src_b = b"\xfd\x0b" + b"\x00" * 6
+        relays = (b"\xfd\x0c" + b"\x00" * 6, b"\xfd\x0d" + b"\x00" * 6)
+
+        def mk_frag_frames(saddr, dgram, relays):
+            frags = HeymacCmdFrag.from_dgram(dgram, 3, 100)
+            return [mk_rxd_frame(saddr, frag, relays[i % len(relays)])
+                    for i, frag in enumerate(frags)]
+
+        # One datagram's fragments arrive through two relays
+        lnk = self._mk_lnk()
+        dgrams = self._get_dgrams(lnk)
+        dgram = bytes(range(250))
+        for f in mk_frag_frames(src_a, dgram, relays):
+            lnk._on_rxd_from_phy(f)
+        self.assertEqual(dgrams, [(src_a, dgram)])
+
+        # Two sources' datagrams with the same ID through the same relay
+        lnk = self._mk_lnk()
+        dgrams = self._get_dgrams(lnk)
+        frames_a = mk_frag_frames(src_a, b"a" * 250, relays[:1])
+        frames_b = mk_frag_frames(src_b, b"b" * 250, relays[:1])
+        for fa, fb in zip(frames_a, frames_b):
+            lnk._on_rxd_from_phy(fa)
+            lnk._on_rxd_from_phy(fb)
+        self.assertEqual(dgrams, [(src_a, b"a" * 250), (src_b, b"b" * 250)])
+
+
+    def test_relay(self,):
+        saddr = b"\xfd\x0a" + b"\x00" * 6
+        taddr = b"\xfd\x0c" + b"\x00" * 6
+        lnk = self._mk_lnk()
+        cmd = HeymacCmdTxt(FLD_MSG=b"hi")
+        lnk._on_rxd_from_phy(mk_rxd_frame(saddr, cmd, taddr, hops=2))
+        self.assertEqual(len(lnk.phy_ahsm.tx), 1)
+        r = HeymacFrame.parse(bytes(lnk.phy_ahsm.tx[0]))
+        self.assertEqual(r.get_field(HeymacFrame.FLD_HOPS), 1)
+        self.assertEqual(r.get_sender(), lnk._lnk_addr)
+        # A payload with the command prefix that does not decode
+        # (a beacon too short for its fields) is not relayed
+        lnk._on_rxd_from_phy(
+            mk_rxd_frame(saddr, b"\x84\x00", taddr, hops=2))
+        self.assertEqual(len(lnk.phy_ahsm.tx), 1)
+
+
+    def test_reassemble_copy(self,):
+        saddr = b"\xfd\x0a" + b"\x00" * 6
+        lnk = self._mk_lnk()
+        dgrams = self._get_dgrams(lnk)
+        for dgram in (b"a" * 250, b"b" * 250):
+            for frag in HeymacCmdFrag.from_dgram(dgram, 3, 100):
+                lnk._on_rxd_from_phy(mk_rxd_frame(saddr, frag))
+        # The first datagram is not overwritten by the second,
+        # though both were reassembled in the same pooled buffer
+        self.assertEqual(dgrams, [(saddr, b"a" * 250), (saddr, b"b" * 250)])
+
+
+    def test_reassemble_cmd_like(self,):
+        saddr = b"\xfd\x0a" + b"\x00" * 6
+        lnk = self._mk_lnk()
+        dgrams = self._get_dgrams(lnk)
+        frames = []
+        lnk.set_rx_clbk(frames.append)
+        # A datagram that starts like a beacon command
+        dgram = b"\x84\x00\x00\x00\x00\x00\x00" + bytes(250)
+        for frag in HeymacCmdFrag.from_dgram(dgram, 3, 100):
+            lnk._on_rxd_from_phy(mk_rxd_frame(saddr, frag))
+        # is given only to the datagram callback, as a datagram
+        self.assertEqual(dgrams, [(saddr, dgram)])
+        self.assertEqual(frames, [])
+        # and is not taken as a beacon by the link data
+        self.assertEqual(lnk._lnk_data.get_ngbr(saddr).bcn_cnt, 0)
+
+
+    def test_rx_aggr(self,):
+        saddr = b"\xfd\x0a" + b"\x00" * 6
+        bcn = HeymacCmdCsmaBcn(
+            FLD_CAPS=0, FLD_STATUS=0, FLD_NETS=(), FLD_NGBRS=())
+        aggr = HeymacCmdAggr.from_cmds(
+            [HeymacCmdTxt(FLD_MSG=b"hi")] * 4 + [bcn])
+        lnk = self._mk_lnk()
+        got = []
+        lnk.set_rx_clbk(got.append)
+        lnk._on_rxd_from_phy(mk_rxd_frame(saddr, aggr, rx_meta=(1.0, -60, 9)))
+        lnk._on_rxd_from_phy(mk_rxd_frame(saddr, aggr, rx_meta=(2.0, -100, 1)))
+        # Each command is given to the NET layer
+        self.assertEqual(len(got), 10)
+        # but each reception is one sample of the link quality
+        ngbr = lnk._lnk_data.get_ngbr(saddr)
+        self.assertEqual(ngbr.bcn_cnt, 2)
+        self.assertAlmostEqual(ngbr.rssi_ewma, -65.0)
+        self.assertAlmostEqual(ngbr.snr_ewma, 8.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+
+import unittest
+
+from lnk_heymac import HeymacFrame, HeymacCmdCsmaBcn, HeymacCmdTxt
+from lnk_heymac.lnk_heymac_cmd import HeymacCmdCsmaBcnHashed
+from lnk_heymac.lnk_data import LnkData, NgbrRec
+
+
+MY_ADDR = b"\xfd" + b"\x00" * 7
+
+
+def mk_rxd_frame(saddr, cmd, rx_meta=(1.0, -60, 9)):
+    """Returns a frame from saddr with the cmd, as received from the PHY."""
+    f = HeymacFrame(
+            HeymacFrame.PID_IDENT_HEYMAC | HeymacFrame.PID_TYPE_CSMA,
+            HeymacFrame.FCTL_L | HeymacFrame.FCTL_S)
+    f.set_field(HeymacFrame.FLD_SADDR, saddr)
+    f.set_field(HeymacFrame.FLD_PAYLD, bytes(cmd))
+    f = HeymacFrame.parse(bytes(f), lazy=True)
+    f.rx_meta = rx_meta
+    return f
+
+
+def mk_bcn(ngbrs=(), nets=(), caps=0):
+    return HeymacCmdCsmaBcn(
+        FLD_CAPS=caps, FLD_STATUS=0, FLD_NETS=nets, FLD_NGBRS=ngbrs)
+
+
+class TestLnkData(unittest.TestCase):
+    """Tests the link layer's neighbor data."""
+
+    def test_ngbr_rec(self,):
+        d = LnkData(MY_ADDR)
+        a = b"\xfd" + b"\x01" * 7
+        d.process_frame(mk_rxd_frame(a, HeymacCmdTxt(FLD_MSG=b"hi")))
+        ngbr = d.get_ngbr(a)
+        self.assertIs(type(ngbr), NgbrRec)
+        self.assertFalse(hasattr(ngbr, "__dict__"))
+        self.assertEqual(ngbr.bcn_cnt, 0)
+        self.assertIsNone(ngbr.caps)
+        self.assertEqual((ngbr.latest_rx_tm, ngbr.latest_rx_rssi,
+                          ngbr.latest_rx_snr), (1.0, -60, 9))
+        self.assertFalse(d.ngbr_hears_me())
+        # Beacons are counted and their data kept
+        nets = ((0x0001, b"\xfdnetroot"),)
+        bcn = mk_bcn(nets=nets, caps=3)
+        d.process_frame(mk_rxd_frame(a, bcn, (2.0, -50, 8)))
+        d.process_frame(mk_rxd_frame(a, bcn, (3.0, -55, 7)))
+        self.assertEqual(ngbr.bcn_cnt, 2)
+        self.assertEqual(ngbr.bcn_rx_tm, 3.0)
+        self.assertEqual(d.get_ngbr_caps(a), 3)
+        self.assertEqual(ngbr.ngbrs, frozenset())
+        self.assertFalse(ngbr.ngbrs_hashed)
+        self.assertEqual(d.get_ngbrs_nets(), list(nets))
+        self.assertIsNone(d.get_ngbr_caps(MY_ADDR))
+
+
+    def test_ngbr_hears_me(self,):
+        d = LnkData(MY_ADDR)
+        a = b"\xfd" + b"\x01" * 7
+        b = b"\xfd" + b"\x02" * 7
+        d.process_frame(mk_rxd_frame(a, mk_bcn(ngbrs=(b,))))
+        self.assertFalse(d.ngbr_hears_me())
+        # Any neighbor, not only the first, can hear this node
+        d.process_frame(mk_rxd_frame(b, mk_bcn(ngbrs=(a, MY_ADDR))))
+        self.assertTrue(d.ngbr_hears_me())
+        self.assertEqual(d.get_bidir_ngbrs_cnt(), 1)
+        d.process_frame(mk_rxd_frame(a, mk_bcn(ngbrs=(b, MY_ADDR))))
+        self.assertEqual(d.get_bidir_ngbrs_cnt(), 2)
+        # A neighbor that no longer lists this node does not hear it
+        d.process_frame(mk_rxd_frame(b, mk_bcn(ngbrs=(a,))))
+        self.assertEqual(d.get_bidir_ngbrs_cnt(), 1)
+        # Nor does an expired neighbor
+        d.update(1.0 + d._expiration_prd + 1)
+        self.assertEqual(d.get_bidir_ngbrs_cnt(), 0)
+        self.assertFalse(d.ngbr_hears_me())
+
+
+    def test_generation(self,):
+        d = LnkData(MY_ADDR)
+        a = b"\xfd" + b"\x01" * 7
+        gen = d.get_generation()
+        d.process_frame(mk_rxd_frame(a, mk_bcn()))
+        self.assertNotEqual(d.get_generation(), gen)
+        gen = d.get_generation()
+        d.process_frame(mk_rxd_frame(a, mk_bcn()))
+        self.assertEqual(d.get_generation(), gen)
+        d.process_frame(mk_rxd_frame(a, mk_bcn(nets=((1, b"\xfdnetroot"),))))
+        self.assertNotEqual(d.get_generation(), gen)
+        gen = d.get_generation()
+        d.process_frame(mk_rxd_frame(
+            a, mk_bcn(nets=((1, b"\xfdnetroot"),), caps=4)))
+        self.assertNotEqual(d.get_generation(), gen)
+
+
+    def test_net_index(self,):
+        d = LnkData(MY_ADDR, expiration_prd=10)
+        a = b"\xfd" + b"\x01" * 7
+        b = b"\xfd" + b"\x02" * 7
+        root = b"\xfdnetroot"
+        net1 = (0x0001, root)
+        net2 = (0x0002, b"\xfdroottwo")
+        d.process_frame(mk_rxd_frame(a, mk_bcn(nets=(net1,)), (1.0, -80, -5)))
+        d.process_frame(
+            mk_rxd_frame(b, mk_bcn(nets=(net1, net2)), (2.0, -50, 9)))
+        self.assertEqual(sorted(d.get_ngbrs_nets()), [net1, net2])
+        self.assertEqual(d.get_net_ngbrs(1), {a, b})
+        self.assertEqual(d.get_net_ngbrs(2), {b})
+        self.assertEqual(d.get_net_ngbrs(3), set())
+        self.assertEqual(d.get_best_ngbr_to_net(1), b)
+        self.assertEqual(d.get_best_ngbr_to_net(2), b)
+        self.assertIsNone(d.get_best_ngbr_to_net(3))
+        # A neighbor stops advertising a net
+        d.process_frame(mk_rxd_frame(b, mk_bcn(nets=(net1,)), (3.0, -50, 9)))
+        self.assertEqual(d.get_ngbrs_nets(), [net1])
+        self.assertEqual(d.get_net_ngbrs(2), set())
+        # An expired neighbor no longer advertises its nets
+        d.update(12.0)
+        self.assertEqual(d.get_net_ngbrs(1), {b})
+        self.assertEqual(d.get_best_ngbr_to_net(1), b)
+        d.update(14.0)
+        self.assertEqual(d.get_ngbrs_nets(), [])
+        self.assertEqual(d._net_index, {})
+
+
+    def test_update(self,):
+        d = LnkData(MY_ADDR, expiration_prd=10)
+        addrs = [b"\xfd" + bytes((i,)) * 7 for i in range(1, 6)]
+        for i, a in enumerate(addrs):
+            d.process_frame(mk_rxd_frame(a, mk_bcn(), (float(i), -60, 9)))
+        # Hearing a neighbor again puts off its expiration
+        d.process_frame(mk_rxd_frame(addrs[0], mk_bcn(), (9.0, -60, 9)))
+        gen = d.get_generation()
+        d.update(10.5)
+        self.assertEqual(set(d.get_ngbrs_lnk_addrs()), set(addrs))
+        self.assertEqual(d.get_generation(), gen)
+        d.update(12.5)
+        self.assertEqual(set(d.get_ngbrs_lnk_addrs()),
+                         set(addrs[:1] + addrs[3:]))
+        self.assertNotEqual(d.get_generation(), gen)
+        self.assertEqual(len(d._expiry), 3)
+        d.update(19.5)
+        self.assertEqual(list(d.get_ngbrs_lnk_addrs()), [])
+        self.assertEqual(d._expiry, [])
+        # An expired neighbor can come back
+        d.process_frame(mk_rxd_frame(addrs[1], mk_bcn(), (20.0, -60, 9)))
+        d.update(25.0)
+        self.assertEqual(list(d.get_ngbrs_lnk_addrs()), [addrs[1]])
+
+
+    def test_link_quality(self,):
+        d = LnkData(MY_ADDR, expiration_prd=1000, bcn_prd=10)
+        a = b"\xfd" + b"\x01" * 7
+        b = b"\xfd" + b"\x02" * 7
+        # Non-beacon frames give RSSI and SNR, but no link quality
+        txt = HeymacCmdTxt(FLD_MSG=b"hi")
+        d.process_frame(mk_rxd_frame(a, txt, (0.0, -60, 8)))
+        self.assertIsNone(d.get_link_quality(a))
+        self.assertIsNone(d.get_link_quality(b))
+        d.process_frame(mk_rxd_frame(a, txt, (1.0, -68, 0)))
+        ngbr = d.get_ngbr(a)
+        self.assertEqual(ngbr.rssi_ewma, -61.0)
+        self.assertEqual(ngbr.snr_ewma, 7.0)
+        # Every beacon heard
+        for i in range(10):
+            d.process_frame(mk_rxd_frame(a, mk_bcn(), (10.0 * i, -60, 8)))
+            d.process_frame(mk_rxd_frame(b, mk_bcn(), (10.0 * i, -60, 8)))
+        self.assertEqual(ngbr.bcn_cnt, 10)
+        self.assertAlmostEqual(ngbr.bcn_prr, 1.0)
+        self.assertAlmostEqual(d.get_link_quality(a), 1.0)
+        # Every other beacon of b is missed
+        for i in range(10, 50, 2):
+            d.process_frame(mk_rxd_frame(a, mk_bcn(), (10.0 * i, -60, 8)))
+            d.process_frame(mk_rxd_frame(a, mk_bcn(), (10.0 * i + 10, -60, 8)))
+            d.process_frame(mk_rxd_frame(b, mk_bcn(), (10.0 * i, -60, 8)))
+        self.assertAlmostEqual(d.get_link_quality(a), 1.0)
+        self.assertLess(d.get_link_quality(b), 0.6)
+        self.assertGreater(d.get_link_quality(b), 0.4)
+        # A low SNR lowers the link quality
+        for i in range(50, 70):
+            d.process_frame(mk_rxd_frame(a, mk_bcn(), (10.0 * i, -120, -6)))
+        self.assertLess(d.get_link_quality(a), 0.2)
+
+
+    def test_link_quality_silent(self,):
+        d = LnkData(MY_ADDR, expiration_prd=1000, bcn_prd=10)
+        a = b"\xfd" + b"\x01" * 7
+        b = b"\xfd" + b"\x02" * 7
+        for i in range(10):
+            d.process_frame(mk_rxd_frame(a, mk_bcn(), (10.0 * i, -60, 8)))
+            d.process_frame(mk_rxd_frame(b, mk_bcn(), (10.0 * i, -60, 8)))
+        self.assertAlmostEqual(d.get_link_quality(b), 1.0)
+        # b stops beaconing; its quality falls as a's beacons arrive
+        for i in range(10, 20):
+            d.process_frame(mk_rxd_frame(a, mk_bcn(), (10.0 * i, -60, 8)))
+        self.assertAlmostEqual(d.get_link_quality(a), 1.0)
+        self.assertAlmostEqual(d.get_link_quality(b), 0.875 ** 10)
+        # and as time passes without any frame
+        d.update(290.0)
+        self.assertAlmostEqual(d.get_link_quality(a), 0.875 ** 10)
+        self.assertAlmostEqual(d.get_link_quality(b), 0.875 ** 20)
+        self.assertAlmostEqual(d.get_link_quality(b, now=95.0), 1.0)
+        # A beacon from b restores some of its quality
+        d.process_frame(mk_rxd_frame(b, mk_bcn(), (300.0, -60, 8)))
+        self.assertAlmostEqual(
+            d.get_link_quality(b), 0.875 ** 21 + 0.125)
+
+
+    def test_two_hop(self,):
+        d = LnkData(MY_ADDR, expiration_prd=10)
+        a, b, c = (b"\xfd" + bytes((i,)) * 7 for i in (1, 2, 3))
+        x, y, z = (b"\xfe" + bytes((i,)) * 7 for i in (1, 2, 3))
+        # a reaches x and y; b reaches y and z; c reaches z only
+        d.process_frame(mk_rxd_frame(a, mk_bcn(ngbrs=(MY_ADDR, x, y))))
+        d.process_frame(mk_rxd_frame(b, mk_bcn(ngbrs=(MY_ADDR, y, z, a))))
+        d.process_frame(mk_rxd_frame(c, mk_bcn(ngbrs=(MY_ADDR, z))))
+        self.assertEqual(d.get_two_hop_ngbrs(), {x, y, z})
+        self.assertEqual(d.get_covering_ngbrs(y), {a, b})
+        self.assertEqual(d.get_covering_ngbrs(a), {b})
+        self.assertEqual(d.get_covering_ngbrs(MY_ADDR), {a, b, c})
+        # a is the only cover of x; then one of b or c covers z
+        mprs = d.get_mprs()
+        self.assertIn(a, mprs)
+        self.assertEqual(len(mprs), 2)
+        self.assertIs(d.get_mprs(), mprs)
+        # c stops hearing z; b is then the only cover of z
+        d.process_frame(
+            mk_rxd_frame(c, mk_bcn(ngbrs=(MY_ADDR,)), (2.0, -60, 9)))
+        self.assertEqual(d.get_covering_ngbrs(z), {b})
+        self.assertEqual(d.get_mprs(), {a, b})
+        # A neighbor that does not hear this node is not a relay
+        d.process_frame(mk_rxd_frame(b, mk_bcn(ngbrs=(y, z)), (2.0, -60, 9)))
+        self.assertEqual(d.get_mprs(), {a})
+        # Expired neighbors no longer cover
+        d.update(11.5)
+        self.assertEqual(set(d.get_ngbrs_lnk_addrs()), {b, c})
+        self.assertEqual(d.get_two_hop_ngbrs(), {y, z})
+        self.assertEqual(d.get_covering_ngbrs(x), set())
+        self.assertEqual(d.get_mprs(), frozenset())
+        # A hashed beacon keeps only its hashes and lists no addresses
+        bcn = HeymacCmdCsmaBcnHashed.from_ngbrs(0, 0, (), (MY_ADDR, z))
+        d.process_frame(mk_rxd_frame(c, bcn, (12.0, -60, 9)))
+        ngbr = d.get_ngbr(c)
+        self.assertTrue(ngbr.ngbrs_hashed)
+        self.assertEqual(ngbr.ngbrs, bcn.get_ngbr_hashes())
+        self.assertTrue(d.ngbr_hears_me())
+        self.assertEqual(d.get_covering_ngbrs(MY_ADDR), set())
+
+
+if __name__ == '__main__':
+    unittest.main()
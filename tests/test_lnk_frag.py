@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+
+import unittest
+
+from lnk_heymac import HeymacCmdFrag, LnkFragReassembler
+from lnk_heymac.lnk_heymac_cmd import HeymacCmd
+
+
+class TestLnkFrag(unittest.TestCase):
+    """Tests the fragmenting and reassembly of datagrams."""
+
+    def _add(self, reasm, sender, frag, now=0.0):
+        return reasm.add_frag(
+            sender,
+            frag.get_field(HeymacCmd.FLD_DGRAM_ID),
+            frag.get_field(HeymacCmd.FLD_DGRAM_SZ),
+            frag.get_field(HeymacCmd.FLD_FRAG_OFF),
+            frag.get_field(HeymacCmd.FLD_FRAG),
+            now)
+
+
+    def test_frag(self,):
+        dgram = bytes(range(256)) * 2
+        frags = HeymacCmdFrag.from_dgram(dgram, 7, 200)
+        self.assertEqual(len(frags), 3)
+        b = bytes(frags[1])
+        self.assertEqual(b[:7], b"\x88\x00\x07\x02\x00\x00\xc8")
+        self.assertEqual(b[7:], dgram[200:400])
+        c = HeymacCmd.parse(b)
+        self.assertIs(type(c), HeymacCmdFrag)
+        self.assertEqual(c.get_field(HeymacCmd.FLD_FRAG), dgram[200:400])
+
+
+    def test_reassemble(self,):
+        reasm = LnkFragReassembler(2, 1024, 8)
+        dgram = bytes(range(256)) * 2
+        frags = HeymacCmdFrag.from_dgram(dgram, 7, 200)
+        # Out of order, with a duplicate
+        self.assertIsNone(self._add(reasm, b"A", frags[2]))
+        self.assertIsNone(self._add(reasm, b"A", frags[0]))
+        self.assertIsNone(self._add(reasm, b"A", frags[0]))
+        self.assertEqual(reasm.get_pending_cnt(), 1)
+        d = self._add(reasm, b"A", frags[1])
+        self.assertIs(type(d), memoryview)
+        self.assertEqual(d, dgram)
+        self.assertEqual(reasm.get_pending_cnt(), 0)
+        # Datagrams are kept apart by sender
+        self.assertIsNone(self._add(reasm, b"A", frags[0]))
+        self.assertIsNone(self._add(reasm, b"B", frags[1]))
+        self.assertEqual(reasm.get_pending_cnt(), 2)
+
+
+    def test_reassemble_overlap(self,):
+        # One buffer, so each datagram reuses the previous one's buffer
+        reasm = LnkFragReassembler(1, 64, 8)
+        self.assertEqual(
+            reasm.add_frag(b"A", 1, 20, 0, b"xxxxxxxxxxTSECRETSxx", 0.0),
+            b"xxxxxxxxxxTSECRETSxx")
+        # B's fragments add up to the datagram's size but overlap,
+        # leaving octets 11..17 unwritten; they must not complete it
+        self.assertIsNone(reasm.add_frag(b"B", 1, 20, 0, b"x", 1.0))
+        self.assertIsNone(reasm.add_frag(b"B", 1, 20, 1, b"y" * 10, 1.0))
+        self.assertIsNone(reasm.add_frag(b"B", 1, 20, 5, b"z" * 7, 1.0))
+        self.assertIsNone(reasm.add_frag(b"B", 1, 20, 18, b"SS", 1.0))
+        self.assertEqual(reasm.get_pending_cnt(), 1)
+        # The missing octets complete it with only B's data
+        d = reasm.add_frag(b"B", 1, 20, 11, b"w" * 7, 1.0)
+        self.assertEqual(d, b"x" + b"y" * 10 + b"w" * 7 + b"SS")
+
+
+    def test_reassemble_limits(self,):
+        reasm = LnkFragReassembler(2, 1024, 8)
+        frags = HeymacCmdFrag.from_dgram(bytes(500), 1, 200)
+        # The oldest datagram is evicted when the pool is empty
+        self._add(reasm, b"A", frags[0], 0.0)
+        self._add(reasm, b"B", frags[0], 1.0)
+        self._add(reasm, b"C", frags[0], 2.0)
+        self.assertEqual(reasm.get_pending_cnt(), 2)
+        self.assertIsNone(self._add(reasm, b"A", frags[1], 3.0))
+        self.assertIsNone(self._add(reasm, b"A", frags[2], 3.0))
+        self.assertEqual(reasm.get_pending_cnt(), 2)
+        # Datagrams that do not complete in time are dropped
+        # (C's first fragment is lost, so C does not complete)
+        self.assertIsNone(self._add(reasm, b"C", frags[1], 10.5))
+        self.assertIsNone(self._add(reasm, b"C", frags[2], 10.5))
+        self.assertEqual(reasm.get_pending_cnt(), 2)
+        self._add(reasm, b"C", frags[0], 20.0)
+        self.assertEqual(reasm.get_pending_cnt(), 1)
+        # Oversize datagrams and fragments are ignored
+        big = HeymacCmdFrag.from_dgram(bytes(2000), 2, 200)
+        self.assertIsNone(self._add(reasm, b"D", big[0], 11.0))
+        self.assertIsNone(reasm.add_frag(b"D", 3, 100, 50, bytes(60), 11.0))
+        self.assertEqual(reasm.get_pending_cnt(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
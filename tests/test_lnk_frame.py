@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 
 
+import hashlib
+import hmac
+import random
 import unittest
 
-from lnk_heymac import HeymacFrame, HeymacFrameError
+from lnk_heymac import HeymacFrame, HeymacFrameError, parse_columnar
+from lnk_heymac.lnk_frame import np
+from lnk_heymac.lnk_heymac_cmd import HeymacCmd, HeymacCmdTxt
 
 
 class TestHeyMacFrame(unittest.TestCase):
@@ -155,5 +160,399 @@ class TestHeyMacFrame(unittest.TestCase):
         self.assertIsNone(f.get_field(HeymacFrame.FLD_TADDR))
 
 
+    def test_mhop(self,):
+        # Build and serialize
+        f = HeymacFrame(
+                HeymacFrame.PID_IDENT_HEYMAC | HeymacFrame.PID_TYPE_CSMA,
+                HeymacFrame.FCTL_S | HeymacFrame.FCTL_M)
+        f.set_field(HeymacFrame.FLD_SADDR, b"\xc1\xc2")
+        f.set_field(HeymacFrame.FLD_PAYLD, b"data")
+        f.set_field(HeymacFrame.FLD_HOPS, 3)
+        f.set_field(HeymacFrame.FLD_TADDR, b"\xe1\xe2")
+        b = bytes(f)
+        self.assertEqual(b, b"\xE4\x06\xc1\xc2data\x03\xe1\xe2")
+        # Parse and test
+        f = HeymacFrame.parse(b)
+        self.assertEqual(f.get_field(HeymacFrame.FLD_FCTL), 0x06)
+        self.assertEqual(f.get_field(HeymacFrame.FLD_SADDR), b"\xc1\xc2")
+        self.assertEqual(f.get_field(HeymacFrame.FLD_PAYLD), b"data")
+        self.assertEqual(f.get_field(HeymacFrame.FLD_HOPS), 3)
+        self.assertEqual(f.get_field(HeymacFrame.FLD_TADDR), b"\xe1\xe2")
+        self.assertEqual(f.get_sender(), b"\xe1\xe2")
+
+
+    def test_ies_mic(self,):
+        # Build and serialize
+        f = HeymacFrame(
+                HeymacFrame.PID_IDENT_HEYMAC | HeymacFrame.PID_TYPE_CSMA,
+                HeymacFrame.FCTL_D | HeymacFrame.FCTL_I | HeymacFrame.FCTL_S |
+                HeymacFrame.FCTL_M)
+        f.set_field(HeymacFrame.FLD_DADDR, b"\xd1\xd2")
+        f.set_field(HeymacFrame.FLD_IES,
+                    ((0x20, b"xyz"), (HeymacFrame.IE_MIC, b"\x04")))
+        f.set_field(HeymacFrame.FLD_SADDR, b"\xc1\xc2")
+        f.set_field(HeymacFrame.FLD_PAYLD, b"data")
+        f.set_field(HeymacFrame.FLD_MIC, b"MMMM")
+        f.set_field(HeymacFrame.FLD_HOPS, 3)
+        f.set_field(HeymacFrame.FLD_TADDR, b"\xe1\xe2")
+        b = bytes(f)
+        self.assertEqual(b, b"\xE4\x1E\xd1\xd2\x20\x03xyz\x01\x01\x04\x00"
+                            b"\xc1\xc2dataMMMM\x03\xe1\xe2")
+        # Parse and test
+        for f in (HeymacFrame.parse(b), HeymacFrame.parse(b, lazy=True)):
+            self.assertEqual(f.get_ie(0x20), b"xyz")
+            self.assertEqual(f.get_ie(HeymacFrame.IE_MIC), b"\x04")
+            self.assertIsNone(f.get_ie(0x21))
+            self.assertEqual(f.get_field(HeymacFrame.FLD_DADDR), b"\xd1\xd2")
+            self.assertEqual(f.get_field(HeymacFrame.FLD_SADDR), b"\xc1\xc2")
+            self.assertEqual(f.get_field(HeymacFrame.FLD_PAYLD), b"data")
+            self.assertEqual(f.get_field(HeymacFrame.FLD_MIC), b"MMMM")
+            self.assertEqual(f.get_field(HeymacFrame.FLD_HOPS), 3)
+            self.assertEqual(f.get_field(HeymacFrame.FLD_TADDR), b"\xe1\xe2")
+            self.assertEqual(f.get_field(HeymacFrame.FLD_IES),
+                             ((0x20, b"xyz"), (HeymacFrame.IE_MIC, b"\x04")))
+        # MIC must agree with the MIC IE
+        f.set_field(HeymacFrame.FLD_MIC, b"MMM")
+        self.assertRaises(HeymacFrameError, bytes, f)
+
+
+    def test_ies_bad(self,):
+        # IEs not terminated
+        self.assertRaises(
+            HeymacFrameError, HeymacFrame.parse, b"\xE4\x08\x20\x03xy")
+        self.assertRaises(
+            HeymacFrameError, HeymacFrame.parse, b"\xE4\x08\x20\x03xyz", True)
+        # MIC IE size is larger than the frame
+        self.assertRaises(
+            HeymacFrameError, HeymacFrame.parse,
+            b"\xE4\x08\x01\x01\x08\x00data")
+        # No IEs field when FCTL_I is set
+        f = HeymacFrame(
+                HeymacFrame.PID_IDENT_HEYMAC | HeymacFrame.PID_TYPE_CSMA,
+                HeymacFrame.FCTL_I)
+        self.assertRaises(HeymacFrameError, bytes, f)
+        f.set_field(HeymacFrame.FLD_IES, ())
+        self.assertEqual(bytes(f), b"\xE4\x08\x00")
+        # A MIC IE without the MIC size is not built (nor parsed)
+        f.set_field(HeymacFrame.FLD_IES, ((HeymacFrame.IE_MIC, b""),))
+        f.set_field(HeymacFrame.FLD_PAYLD, b"ab")
+        self.assertRaises(HeymacFrameError, bytes, f)
+        self.assertRaises(
+            HeymacFrameError, HeymacFrame.parse,
+            bytes.fromhex("e40c010000616278"))
+
+
+    def test_mic(self,):
+        key = b"0123456789abcdef"
+        f = HeymacFrame(
+                HeymacFrame.PID_IDENT_HEYMAC | HeymacFrame.PID_TYPE_CSMA,
+                HeymacFrame.FCTL_I | HeymacFrame.FCTL_S | HeymacFrame.FCTL_M)
+        f.set_field(HeymacFrame.FLD_SADDR, b"\xc1\xc2")
+        f.set_field(HeymacFrame.FLD_PAYLD, b"data")
+        f.set_field(HeymacFrame.FLD_HOPS, 3)
+        f.set_field(HeymacFrame.FLD_TADDR, b"\xe1\xe2")
+        f.add_mic(key, 4)
+        self.assertEqual(f.get_ie(HeymacFrame.IE_MIC), b"\x04")
+        self.assertEqual(len(f.get_field(HeymacFrame.FLD_MIC)), 4)
+        self.assertTrue(f.verify_mic(key))
+        b = bytes(f)
+        for f in (HeymacFrame.parse(b), HeymacFrame.parse(b, lazy=True)):
+            self.assertTrue(f.verify_mic(key))
+            self.assertFalse(f.verify_mic(b"wrong key"))
+        # A relayed frame keeps a valid MIC
+        r = HeymacFrame.parse(bytes(f.mk_relay(b"\xf1\xf2")))
+        self.assertTrue(r.verify_mic(key))
+        # A modified payload does not
+        t = bytearray(b)
+        t[8] ^= 0xff
+        t = HeymacFrame.parse(bytes(t))
+        self.assertFalse(t.verify_mic(key))
+        # Batch verify
+        keys = {b"\xe1\xe2": key, b"\xf1\xf2": key}
+        plain = HeymacFrame.parse(b"\xE4\x04\xc1\xc2data")
+        self.assertEqual(
+            HeymacFrame.verify_mics(
+                (f, r, t, plain), lambda f: keys.get(f.get_sender())),
+            [True, True, False, False])
+        # A MIC needs the MIC IE (and so the IEs field)
+        g = HeymacFrame(
+                HeymacFrame.PID_IDENT_HEYMAC | HeymacFrame.PID_TYPE_CSMA,
+                HeymacFrame.FCTL_S)
+        g.set_field(HeymacFrame.FLD_SADDR, b"\xc1\xc2")
+        g.set_field(HeymacFrame.FLD_MIC, b"\x01\x02\x03\x04")
+        self.assertRaises(HeymacFrameError, bytes, g)
+        # The MIC is the truncated HMAC-SHA256; the key may be a bytearray
+        mic = hmac.new(key, b[:-7], hashlib.sha256).digest()[:4]
+        self.assertEqual(f.get_field(HeymacFrame.FLD_MIC), mic)
+        self.assertTrue(f.verify_mic(bytearray(key)))
+        self.assertEqual(
+            HeymacFrame.verify_mics((f,), lambda f: bytearray(key)), [True])
+
+
+    def test_lazy_parse(self,):
+        b = bytearray(b"\xE4\x36\x80\xa5\xd1\xd2\xc1\xc2data\x03\xe1\xe2")
+        f = HeymacFrame.parse(b, lazy=True)
+        self.assertEqual(f.get_field(HeymacFrame.FLD_FCTL), 0x36)
+        self.assertEqual(f.get_sender(), b"\xe1\xe2")
+        self.assertEqual(f.get_field(HeymacFrame.FLD_NETID), b"\x80\xA5")
+        self.assertEqual(f.get_field(HeymacFrame.FLD_DADDR), b"\xd1\xd2")
+        self.assertEqual(f.get_field(HeymacFrame.FLD_SADDR), b"\xc1\xc2")
+        self.assertEqual(f.get_field(HeymacFrame.FLD_PAYLD), b"data")
+        self.assertEqual(f.get_field(HeymacFrame.FLD_HOPS), 3)
+        self.assertIs(type(f.get_field(HeymacFrame.FLD_PAYLD)), bytes)
+        # A set field replaces the unparsed value
+        f.set_field(HeymacFrame.FLD_HOPS, 2)
+        self.assertEqual(
+            bytes(f), b"\xE4\x36\x80\xa5\xd1\xd2\xc1\xc2data\x02\xe1\xe2")
+
+
+    def test_lazy_parse_bad(self,):
+        # Frame too short for its Fctl fields
+        self.assertRaises(
+            HeymacFrameError, HeymacFrame.parse, b"\xE4\x14\xd1", True)
+        # Long address selected, but no address field
+        self.assertRaises(
+            HeymacFrameError, HeymacFrame.parse, b"\xE4\x40", True)
+        # NetId is not an address field
+        self.assertRaises(
+            HeymacFrameError, HeymacFrame.parse, b"\xE4\x60\x12\x34\x83hi",
+            True)
+
+
+    def test_trusted_parse(self,):
+        b = b"\xE4\x36\x80\xa5\xd1\xd2\xc1\xc2data\x03\xe1\xe2"
+        f = HeymacFrame.parse(b, trusted=True)
+        self.assertEqual(f.get_field(HeymacFrame.FLD_NETID), b"\x80\xA5")
+        self.assertEqual(f.get_field(HeymacFrame.FLD_PAYLD), b"data")
+        self.assertEqual(f.get_sender(), b"\xe1\xe2")
+        self.assertEqual(bytes(f), b)
+        # Layout checks still apply
+        for b in (b"\x00\x00", b"\xE4\x14\xd1", b"\xE4\x40", b"\xE4\x90",
+                  b"\xE4\x60\x12\x34"):
+            self.assertRaises(
+                HeymacFrameError, HeymacFrame.parse, b, trusted=True)
+
+
+    def test_pack_into(self,):
+        f = HeymacFrame(
+                HeymacFrame.PID_IDENT_HEYMAC | HeymacFrame.PID_TYPE_CSMA,
+                HeymacFrame.FCTL_S | HeymacFrame.FCTL_M)
+        f.set_field(HeymacFrame.FLD_SADDR, b"\xc1\xc2")
+        f.set_field(HeymacFrame.FLD_PAYLD, b"data")
+        f.set_field(HeymacFrame.FLD_HOPS, 3)
+        f.set_field(HeymacFrame.FLD_TADDR, b"\xe1\xe2")
+        buf = bytearray(16)
+        n = f.pack_into(buf, 2)
+        self.assertEqual(n, 11)
+        self.assertEqual(
+            buf, b"\x00\x00\xE4\x06\xc1\xc2data\x03\xe1\xe2\x00\x00\x00")
+        # Too small a buffer is not resized
+        self.assertRaises(HeymacFrameError, f.pack_into, bytearray(10))
+        # Serialized form is cached until a field is set
+        b = bytes(f)
+        self.assertIs(bytes(f), b)
+        f.set_field(HeymacFrame.FLD_HOPS, 2)
+        self.assertEqual(bytes(f), b"\xE4\x06\xc1\xc2data\x02\xe1\xe2")
+        n = f.pack_into(buf)
+        self.assertEqual(buf[:n], b"\xE4\x06\xc1\xc2data\x02\xe1\xe2")
+
+
+    def test_mk_relay(self,):
+        b = b"\xE4\x06\xc1\xc2data\x03\xe1\xe2"
+        for f in (HeymacFrame.parse(b),
+                  HeymacFrame.parse(bytearray(b), lazy=True)):
+            r = f.mk_relay(b"\xf1\xf2")
+            self.assertEqual(r, b"\xE4\x06\xc1\xc2data\x02\xf1\xf2")
+            # The original frame is unchanged
+            self.assertEqual(f.get_field(HeymacFrame.FLD_HOPS), 3)
+            self.assertEqual(bytes(f), b)
+        # A built (not yet serialized) frame is packed into the relay
+        f = HeymacFrame(
+                HeymacFrame.PID_IDENT_HEYMAC | HeymacFrame.PID_TYPE_CSMA,
+                HeymacFrame.FCTL_S | HeymacFrame.FCTL_M)
+        f.set_field(HeymacFrame.FLD_SADDR, b"\xc1\xc2")
+        f.set_field(HeymacFrame.FLD_PAYLD, b"data")
+        f.set_field(HeymacFrame.FLD_HOPS, 3)
+        f.set_field(HeymacFrame.FLD_TADDR, b"\xe1\xe2")
+        r = f.mk_relay(b"\xf1\xf2")
+        self.assertIs(type(r), bytearray)
+        self.assertEqual(r, b"\xE4\x06\xc1\xc2data\x02\xf1\xf2")
+        f = HeymacFrame.parse(b"\xE4\x06\xc1\xc2data\x00\xe1\xe2")
+        self.assertRaises(HeymacFrameError, f.mk_relay, b"\xf1\xf2")
+
+
+    def test_parse_many(self,):
+        good = b"\xE4\x14\xd1\xd2\xc1\xc2hello world"
+        frames, errors = HeymacFrame.parse_many(
+            (good, b"\x00\x00", b"\xE4", good))
+        self.assertEqual(len(frames), 4)
+        self.assertEqual(
+            frames[0].get_field(HeymacFrame.FLD_PAYLD), b"hello world")
+        self.assertIsNone(frames[1])
+        self.assertIsNone(frames[2])
+        self.assertEqual(
+            frames[3].get_field(HeymacFrame.FLD_SADDR), b"\xc1\xc2")
+        self.assertEqual([i for i, _ in errors], [1, 2])
+        for _, e in errors:
+            self.assertIsInstance(e, HeymacFrameError)
+
+
+    def test_parse_many_length_prefixed(self,):
+        buf = b"\x00\x06\xE4\x00ABCD" \
+              b"\x00\x02\x00\x00" \
+              b"\x00\x04\xE4\x44\x01"
+        frames, errors = HeymacFrame.parse_many(buf, lazy=True)
+        self.assertEqual(len(frames), 3)
+        self.assertEqual(frames[0].get_field(HeymacFrame.FLD_PAYLD), b"ABCD")
+        self.assertIsNone(frames[1])
+        self.assertIsNone(frames[2])
+        self.assertEqual([i for i, _ in errors], [1, 2])
+
+
+    @unittest.skipIf(np is None, "NumPy is not installed")
+    def test_parse_columnar(self,):
+        frames = (
+            b"\xE4\x36\x80\xa5\xd1\xd2\xc1\xc2data\x03\xe1\xe2",
+            b"\xE4\x44\x01\x02\x03\x04\x05\x06\x07\x08",
+            b"\x00\x00",
+            b"\xE4\x14\xd1",
+            b"\xE4\x80extended",
+            b"\xE4\x1E\xd1\xd2\x20\x03xyz\x01\x01\x04\x00"
+            b"\xc1\xc2dataMMMM\x03\xe1\xe2",
+        )
+        cols = parse_columnar(frames)
+        self.assertEqual(list(cols["valid"]),
+                         [True, True, False, False, True, True])
+        # Agrees with the object parser for valid frames
+        for row, b in zip(cols, frames):
+            if not row["valid"]:
+                continue
+            f = HeymacFrame.parse(b)
+            self.assertEqual(row["fctl"], f.get_field(HeymacFrame.FLD_FCTL))
+            payld = f.get_field(HeymacFrame.FLD_PAYLD) or b""
+            self.assertEqual(
+                b[row["payld_offset"]:row["payld_offset"] + row["payld_len"]],
+                payld)
+        self.assertEqual(cols[0]["netid"], 0x80a5)
+        self.assertEqual(cols[0]["daddr"], 0xd1d2)
+        self.assertEqual(cols[0]["saddr"], 0xc1c2)
+        self.assertEqual(cols[0]["hops"], 3)
+        self.assertEqual(cols[0]["taddr"], 0xe1e2)
+        self.assertEqual(cols[1]["saddr"], 0x0102030405060708)
+        self.assertEqual(cols[1]["daddr"], 0)
+        self.assertEqual(cols[5]["saddr"], 0xc1c2)
+        self.assertEqual(cols[5]["payld_len"], 4)
+        self.assertEqual(cols[5]["taddr"], 0xe1e2)
+        # Length-prefixed input gives the same result
+        buf = b"".join(len(b).to_bytes(2, "big") + b for b in frames)
+        self.assertTrue((parse_columnar(buf) == cols).all())
+
+        # "valid" is False exactly when HeymacFrame.parse() fails,
+        # over every Fctl value and a range of frame lengths
+        rng = random.Random(5)
+        frames = [b"\xE4" + bytes((fctl,)) +
+                  bytes(rng.randrange(256) for _ in range(sz))
+                  for fctl in range(256) for sz in (0, 2, 5, 10, 20, 40)]
+        cols = parse_columnar(frames)
+        for row, b in zip(cols, frames):
+            try:
+                f = HeymacFrame.parse(b)
+            except HeymacFrameError:
+                f = None
+            self.assertEqual(row["valid"], f is not None, b.hex())
+            if f is not None:
+                payld = f.get_field(HeymacFrame.FLD_PAYLD) or b""
+                payld_off = row["payld_offset"]
+                self.assertEqual(
+                    b[payld_off:payld_off + row["payld_len"]], payld)
+
+
+    def test_slots(self,):
+        f = HeymacFrame(
+                HeymacFrame.PID_IDENT_HEYMAC | HeymacFrame.PID_TYPE_CSMA,
+                0)
+        self.assertFalse(hasattr(f, "__dict__"))
+        self.assertIsNone(f.rx_meta)
+        self.assertIsNone(f.cmd)
+        f.rx_meta = (1.0, -60, 9)
+        self.assertEqual(f.rx_meta, (1.0, -60, 9))
+        self.assertRaises(AttributeError, setattr, f, "bob", 1)
+
+
+    def test_lazy_cmd(self,):
+        f = HeymacFrame(
+                HeymacFrame.PID_IDENT_HEYMAC | HeymacFrame.PID_TYPE_CSMA,
+                HeymacFrame.FCTL_S)
+        f.set_field(HeymacFrame.FLD_SADDR, b"\x35\x16")
+        f.set_field(HeymacFrame.FLD_PAYLD, b"\x83Hello")
+        b = bytes(f)
+        f = HeymacFrame.parse(b, lazy=True)
+        # Peeking the CMD_ID neither decodes nor copies the payload
+        self.assertEqual(f.get_cmd_id(), HeymacCmdTxt.CMD_ID)
+        self.assertIs(f._cmd, HeymacFrame._CMD_UNDECODED)
+        self.assertIsNone(f._payld)
+        # The command is decoded once and kept
+        cmd = f.cmd
+        self.assertIs(type(cmd), HeymacCmdTxt)
+        self.assertEqual(cmd.get_field(HeymacCmd.FLD_MSG), b"Hello")
+        self.assertIs(f.cmd, cmd)
+        # Setting the payload discards the decoded command
+        f.set_field(HeymacFrame.FLD_PAYLD, b"not a cmd")
+        self.assertIsNone(f.get_cmd_id())
+        self.assertIsNone(f.cmd)
+        # A decode failure is kept
+        f = HeymacFrame.parse(b[:-6] + b"\xbf", lazy=True)
+        self.assertEqual(f.get_cmd_id(), 0x3f)
+        self.assertIsNone(f.cmd)
+        self.assertIsNone(f._cmd)
+        # The command can be set by the LNK layer
+        f.cmd = cmd
+        self.assertIs(f.cmd, cmd)
+
+
+    def test_copy_with_payld(self,):
+        f = HeymacFrame(
+                HeymacFrame.PID_IDENT_HEYMAC | HeymacFrame.PID_TYPE_CSMA,
+                HeymacFrame.FCTL_D | HeymacFrame.FCTL_S | HeymacFrame.FCTL_M)
+        f.set_field(HeymacFrame.FLD_DADDR, b"\x01\xE3")
+        f.set_field(HeymacFrame.FLD_SADDR, b"\x35\x16")
+        f.set_field(HeymacFrame.FLD_PAYLD, b"\x87\x02\x83A")
+        f.set_field(HeymacFrame.FLD_HOPS, 2)
+        f.set_field(HeymacFrame.FLD_TADDR, b"\x35\x17")
+        f = HeymacFrame.parse(bytes(f), lazy=True)
+        f.rx_meta = (1.0, -60, 9)
+        c = f.copy_with_payld(b"\x83A")
+        self.assertEqual(c.get_field(HeymacFrame.FLD_PAYLD), b"\x83A")
+        self.assertEqual(c.get_cmd_id(), HeymacCmdTxt.CMD_ID)
+        self.assertIs(type(c.cmd), HeymacCmdTxt)
+        self.assertIs(c.rx_meta, f.rx_meta)
+        for fld_nm in (HeymacFrame.FLD_DADDR, HeymacFrame.FLD_SADDR,
+                       HeymacFrame.FLD_HOPS, HeymacFrame.FLD_TADDR):
+            self.assertEqual(c.get_field(fld_nm), f.get_field(fld_nm))
+        self.assertEqual(bytes(c), bytes(f)[:-7] + b"\x83A" + bytes(f)[-3:])
+
+
+    def test_layout(self,):
+        # The precomputed layout agrees with the Fctl accessors
+        for fctl in range(256):
+            f = HeymacFrame(
+                    HeymacFrame.PID_IDENT_HEYMAC | HeymacFrame.PID_TYPE_CSMA,
+                    fctl)
+            lyt = HeymacFrame._LAYOUT[fctl]
+            addr_sz = (2, 8)[f.is_long_addrs()]
+            self.assertEqual(lyt.addr_sz, addr_sz)
+            self.assertEqual(HeymacFrame.FLD_NETID in lyt.hdr_flds,
+                             f.is_netid_present())
+            self.assertEqual(HeymacFrame.FLD_DADDR in lyt.hdr_flds,
+                             f.is_daddr_present())
+            self.assertEqual(HeymacFrame.FLD_SADDR in lyt.hdr_flds,
+                             f.is_saddr_present())
+            self.assertEqual(lyt.mhop_sz, (0, 1 + addr_sz)[f.is_mhop()])
+            self.assertEqual(lyt.hdr_sz, 2 +
+                             2 * f.is_netid_present() +
+                             addr_sz * f.is_daddr_present() +
+                             addr_sz * f.is_saddr_present())
+
+
 if __name__ == '__main__':
     unittest.main()
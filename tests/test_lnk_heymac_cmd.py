@@ -2,6 +2,7 @@
 
 
 import unittest
+import zlib
 
 from lnk_heymac.lnk_heymac_cmd import *
 
@@ -20,6 +21,27 @@ class TestHeyMacCmd(unittest.TestCase):
         self.assertEqual(c.get_field(HeymacCmd.FLD_MSG), b"Hello world")
 
 
+    def test_ztxt(self,):
+        msg = b"CQ CQ CQ DE KC4KSU KC4KSU K"
+        c = HeymacCmdZtxt.from_msg(msg)
+        self.assertIs(type(c), HeymacCmdZtxt)
+        b = bytes(c)
+        self.assertEqual(b[0], 0x89)
+        self.assertLess(len(b), 1 + len(msg))
+        # Parse and test
+        c = HeymacCmd.parse(b)
+        self.assertIs(type(c), HeymacCmdZtxt)
+        self.assertEqual(c.get_field(HeymacCmd.FLD_MSG), msg)
+        # Text that does not compress is sent plain
+        c = HeymacCmdZtxt.from_msg(b"\x8f\x07")
+        self.assertIs(type(c), HeymacCmdTxt)
+        self.assertEqual(bytes(c), b"\x83\x8f\x07")
+        # Bad compressed data
+        self.assertRaises(HeymacCmdError, HeymacCmd.parse, b[:-1])
+        self.assertRaises(HeymacCmdError, HeymacCmd.parse, b + b"\x00")
+        self.assertRaises(HeymacCmdError, HeymacCmd.parse, b"\x89\xff\xff")
+
+
     def test_bcn(self,):
         # Build and serialize
         c = HeymacCmdCsmaBcn(
@@ -34,8 +56,69 @@ class TestHeyMacCmd(unittest.TestCase):
         self.assertIs(type(c), HeymacCmdCsmaBcn)
         self.assertEqual(c.get_field(HeymacCmd.FLD_CAPS), 0x0102)
         self.assertEqual(c.get_field(HeymacCmd.FLD_STATUS), 0x0304)
-        self.assertEqual(c.get_field(HeymacCmd.FLD_NETS), (0x0001, b"\xfdnetroot"))
+        self.assertEqual(c.get_field(HeymacCmd.FLD_NETS),
+                         ((0x0001, b"\xfdnetroot"),))
         self.assertEqual(c.get_field(HeymacCmd.FLD_NGBRS), (b"\xfd2345678",))
+        self.assertTrue(c.has_ngbr(b"\xfd2345678"))
+        self.assertFalse(c.has_ngbr(b"\xfd3456789"))
+
+
+    def test_bcn_hashed(self,):
+        ngbrs = tuple(bytes((0xfd,)) + i.to_bytes(7, "big")
+                      for i in range(100))
+        c = HeymacCmdCsmaBcnHashed.from_ngbrs(
+            0x0102, 0x0304, ((0x0001, b"\xfdnetroot"),), ngbrs)
+        b = bytes(c)
+        self.assertEqual(b[:6], b"\x86\x01\x02\x03\x04\x01")
+        # Two octets per neighbor (less any hash collisions)
+        self.assertLessEqual(len(b), 1 + 4 + 1 + 10 + 1 + 2 * len(ngbrs))
+        # Parse and test
+        c = HeymacCmd.parse(b)
+        self.assertIs(type(c), HeymacCmdCsmaBcnHashed)
+        self.assertEqual(c.get_field(HeymacCmd.FLD_NETS),
+                         ((0x0001, b"\xfdnetroot"),))
+        for ngbr in ngbrs:
+            self.assertTrue(c.has_ngbr(ngbr))
+        self.assertEqual(c.ngbr_hash(ngbrs[0]), zlib.crc32(ngbrs[0]) & 0xFFFF)
+        hash_set = set(c.get_field(HeymacCmd.FLD_NGBR_HASHES))
+        self.assertEqual(c.get_ngbr_hashes(), hash_set)
+        others = [a for a in (b"\xfe" + i.to_bytes(7, "big")
+                              for i in range(100))
+                  if c.ngbr_hash(a) not in hash_set]
+        self.assertTrue(others)
+        for other in others:
+            self.assertFalse(c.has_ngbr(other))
+
+
+    def test_aggr(self,):
+        cmds = (HeymacCmdTxt(FLD_MSG=b"Hi"),
+                HeymacCmdJoinAcpt(FLD_NET_ID=0x0102, FLD_NET_ADDR=0x0123),
+                HeymacCmdJoinLeav())
+        c = HeymacCmdAggr.from_cmds(cmds)
+        b = bytes(c)
+        self.assertEqual(
+            b, b"\x87\x03\x83Hi\x06\x85\x02\x01\x02\x01\x23\x02\x85\x05")
+        # Parse and test
+        c = HeymacCmd.parse(b)
+        self.assertIs(type(c), HeymacCmdAggr)
+        self.assertEqual(c.get_cmds_bytes(), tuple(bytes(cmd) for cmd in cmds))
+        self.assertEqual([type(cmd) for cmd in c.get_cmds()],
+                         [type(cmd) for cmd in cmds])
+        # An unknown command is None
+        c = HeymacCmd.parse(b"\x87\x01\xbf\x02\x83A")
+        self.assertEqual([type(cmd) for cmd in c.get_cmds()],
+                         [type(None), HeymacCmdTxt])
+        # Bad lengths
+        self.assertRaises(HeymacCmdError, HeymacCmd.parse, b[:-1])
+        self.assertRaises(HeymacCmdError, HeymacCmd.parse, b"\x87\x00")
+        # Aggregates are not nested and hold only small commands
+        self.assertRaises(HeymacCmdError, HeymacCmdAggr.from_cmds, (c,))
+        self.assertRaises(HeymacCmdError, HeymacCmdAggr.from_cmds,
+                          (HeymacCmdTxt(FLD_MSG=bytes(255)),))
+        # An aggregate holds one or more commands, none empty
+        self.assertRaises(HeymacCmdError, HeymacCmdAggr.from_cmds, ())
+        self.assertRaises(HeymacCmdError, HeymacCmdAggr.from_cmds,
+                          (HeymacCmdTxt(FLD_MSG=b"Hi"), b""))
 
 
     def test_join_rqst(self,):
@@ -173,5 +256,58 @@ class TestHeyMacCmd(unittest.TestCase):
         self.assertRaises(HeymacCmdError, HeymacCmd.parse, b"\x85\x05\x05")
 
 
+    def test_registry(self,):
+        # A command defined outside the module is parsed by HeymacCmd.parse()
+        class HeymacCmdTest(HeymacCmd):
+            CMD_ID = 40
+            _TAIL = HeymacCmd.FLD_MSG
+        self.addCleanup(HeymacCmd._CMD_REGISTRY.pop, (40, None))
+        c = HeymacCmd.parse(b"\xA8abc")
+        self.assertIs(type(c), HeymacCmdTest)
+        self.assertEqual(c.get_field(HeymacCmd.FLD_MSG), b"abc")
+        # A Command ID can only be registered once
+
+        def _dup_cmd_id():
+            class HeymacCmdDup(HeymacCmd):
+                CMD_ID = 40
+        self.assertRaises(HeymacCmdError, _dup_cmd_id)
+        # Join sub-commands are registered by their SUB_ID
+        self.assertIs(HeymacCmd._CMD_REGISTRY[(5, 2)], HeymacCmdJoinAcpt)
+        self.assertNotIn((5, None), HeymacCmd._CMD_REGISTRY)
+        # A base of sub-commands parses only its own sub-commands
+        self.assertIs(
+            type(HeymacCmdJoin.parse(b"\x85\x05")), HeymacCmdJoinLeav)
+        self.assertRaises(HeymacCmdError, HeymacCmdJoin.parse, b"\x83hi")
+        self.assertRaises(HeymacCmdError, HeymacCmdJoin.parse, b"\xA8abc")
+
+
+    def test_schema(self,):
+        # Layouts are compiled once, when the class is defined
+        schema = HeymacCmdCsmaBcn._SCHEMA
+        self.assertEqual(schema.fixed.size, 4)
+        self.assertEqual(HeymacCmdCsmaBcn._FLD_LIST, (
+            HeymacCmd.FLD_CAPS, HeymacCmd.FLD_STATUS,
+            HeymacCmd.FLD_NETS, HeymacCmd.FLD_NGBRS))
+        # Beacon with several nets and ngbrs
+        nets = ((0x0001, b"\xfdnetroot"), (0x0002, b"\xfdnetroo2"))
+        ngbrs = (b"\xfd2345678", b"\xfd3456789", b"\xfd4567890")
+        c = HeymacCmdCsmaBcn(FLD_CAPS=1, FLD_STATUS=2,
+                             FLD_NETS=nets, FLD_NGBRS=ngbrs)
+        b = bytes(c)
+        self.assertEqual(len(b), 1 + 4 + 1 + 2 * 10 + 1 + 3 * 8)
+        c = HeymacCmd.parse(b)
+        self.assertEqual(c.get_field(HeymacCmd.FLD_NETS), nets)
+        self.assertEqual(c.get_field(HeymacCmd.FLD_NGBRS), ngbrs)
+        # A count that runs past the data
+        self.assertRaises(HeymacCmdError, HeymacCmd.parse, b[:-1])
+        self.assertRaises(HeymacCmdError, HeymacCmd.parse, b + b"\x00")
+        # Parsing by a subclass checks the header
+        self.assertRaises(HeymacCmdError, HeymacCmdTxt.parse, b)
+        self.assertRaises(HeymacCmdError, HeymacCmdJoinAcpt.parse,
+                          b"\x85\x03\x01\x02\x03\x04")
+        # All fields are needed to build a command
+        self.assertRaises(HeymacCmdError, HeymacCmdJoinAcpt, FLD_NET_ID=1)
+
+
 if __name__ == '__main__':
     unittest.main()